@@ -16,6 +16,7 @@ setup(
     packages=[
         "djapian",
         "djapian.utils",
+        "djapian.benchmark",
         "djapian.tests",
         "djapian.management",
         "djapian.management.commands"
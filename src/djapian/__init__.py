@@ -5,6 +5,7 @@ from djapian.database import Database
 from djapian.space import IndexSpace
 from djapian.utils import load_indexes
 from djapian.decider import X
+from djapian.resultset import search_many
 
 space = IndexSpace(settings.DJAPIAN_DATABASE_PATH, "global")
 
@@ -0,0 +1,133 @@
+"""
+Benchmarks of indexing and search on synthetic corpora of test models.
+They are run by `indexbenchmark` management command which writes results
+as JSON, so runs made on different revisions can be compared.
+"""
+import time
+
+import xapian
+
+from djapian.models import Change
+from djapian.benchmark.corpus import Corpus
+from djapian.tests.utils import Entry, Comment
+
+SEARCHES = (
+    ("search", lambda query: list(Entry.indexer.search(query)[:10])),
+    ("filter", lambda query: list(
+        Entry.indexer.search(query).filter(count__gte=10)[:10]
+    )),
+    ("order_by", lambda query: list(
+        Entry.indexer.search(query).order_by("-rating")[:10]
+    )),
+    ("count", lambda query: Entry.indexer.search(query).count()),
+    ("prefetch", lambda query: [
+        hit.instance for hit in
+        Entry.indexer.search(query).prefetch(select_related=True)[:10]
+    ]),
+)
+
+def percentile(timings, fraction):
+    """
+    Returns value below which `fraction` of sorted `timings` lie
+    """
+    index = int(round(fraction * (len(timings) - 1)))
+    return timings[index]
+
+def measure_rate(func, count):
+    """
+    Runs `func` and returns how fast it handles `count` items
+    """
+    started = time.time()
+    func()
+    seconds = time.time() - started
+
+    return {
+        "items": count,
+        "seconds": seconds,
+        "per_second": seconds and count / seconds or None,
+    }
+
+def measure_latency(func, arguments):
+    """
+    Calls `func` with each of `arguments` and returns latency
+    percentiles in milliseconds
+    """
+    timings = []
+
+    for argument in arguments:
+        started = time.time()
+        func(argument)
+        timings.append((time.time() - started) * 1000)
+
+    timings.sort()
+
+    return {
+        "runs": len(timings),
+        "p50": percentile(timings, 0.5),
+        "p99": percentile(timings, 0.99),
+        "mean": sum(timings) / len(timings),
+    }
+
+def bench_update():
+    Entry.indexer.clear()
+
+    return measure_rate(
+        lambda: Entry.indexer.update(),
+        Entry.objects.filter(is_active=True).count()
+    )
+
+def bench_rebuild(workers):
+    from djapian.management.commands.index import rebuild_index, get_address
+
+    def rebuild():
+        for indexer in (Entry.indexer, Comment.indexer):
+            rebuild_index(get_address(indexer), None, False, False, False,
+                          None, workers)
+
+    return measure_rate(
+        rebuild,
+        Entry.objects.filter(is_active=True).count() + Comment.objects.count()
+    )
+
+def bench_drain(count):
+    from djapian.management.commands.index import update_changes
+
+    for entry in Entry.objects.all()[:count]:
+        entry.save()
+
+    return measure_rate(
+        lambda: update_changes(False, 0, True, False, False, 500),
+        Change.objects.count()
+    )
+
+def run(size=1000, queries=100, workers=1, seed=0):
+    """
+    Creates corpus of `size` entries and runs all benchmarks on it. Test
+    database should be set up by the caller.
+    """
+    corpus = Corpus(size, seed)
+    corpus.create()
+    # Changes logged while the corpus was created are not needed
+    Change.objects.all().delete()
+
+    results = {
+        "update": bench_update(),
+        "rebuild": bench_rebuild(workers),
+        "drain": bench_drain(max(1, size // 10)),
+    }
+
+    query_list = corpus.get_queries(queries)
+    for name, func in SEARCHES:
+        results[name] = measure_latency(func, query_list)
+
+    Entry.indexer.clear()
+    Comment.indexer.clear()
+
+    return {
+        "size": size,
+        "queries": queries,
+        "workers": workers,
+        "seed": seed,
+        "xapian": xapian.version_string(),
+        "results": results,
+    }
@@ -0,0 +1,61 @@
+import random
+from datetime import datetime, timedelta
+
+from djapian.tests.utils import Person, Entry, Comment
+
+WORDS = (
+    "xapian", "django", "index", "search", "query", "document", "term",
+    "value", "field", "model", "python", "database", "server", "cache",
+    "result", "filter", "order", "weight", "stem", "language", "text",
+    "title", "author", "comment", "entry", "rating", "tag", "daemon",
+    "change", "update", "rebuild", "shard", "compact", "thread", "process",
+    "memory", "disk", "latency", "request", "response", "page", "window",
+    "spelling", "phrase", "boolean", "prefix", "parser", "match", "rank",
+    "percent", "relevance", "estimate", "count", "limit", "offset", "slice",
+    "revision", "snapshot", "transaction", "flush", "writer", "reader",
+)
+
+class Corpus(object):
+    """
+    Synthetic set of `Person`, `Entry` and `Comment` objects built from
+    a fixed vocabulary. Same `seed` produces same corpus, so runs on
+    different revisions measure the same data.
+    """
+    def __init__(self, size, seed=0, words=WORDS):
+        self.size = size
+        self.words = words
+
+        self._random = random.Random(seed)
+
+    def create(self):
+        persons = [
+            Person.objects.create(name="Person %d" % number)
+            for number in range(max(1, self.size // 10))
+        ]
+
+        now = datetime.now()
+
+        for number in range(self.size):
+            entry = Entry.objects.create(
+                author=self._random.choice(persons),
+                title=self.get_text(4),
+                tags=self.get_text(2),
+                created_on=now - timedelta(minutes=self._random.randint(0, 60 * 24 * 365)),
+                rating=round(self._random.uniform(0, 5), 2),
+                asset_count=self._random.randint(0, 20),
+                is_active=self._random.random() > 0.1,
+                text=self.get_text(60)
+            )
+
+            if number % 2 == 0:
+                Comment.objects.create(
+                    entry=entry,
+                    author=self._random.choice(persons),
+                    text=self.get_text(20)
+                )
+
+    def get_text(self, length):
+        return " ".join([self._random.choice(self.words) for i in range(length)])
+
+    def get_queries(self, count):
+        return [self.get_text(self._random.randint(1, 2)) for i in range(count)]
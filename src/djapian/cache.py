@@ -0,0 +1,103 @@
+"""
+Search result caches. Set one as `Indexer.result_cache` to serve repeated
+queries without touching Xapian. Cache keys include database revision so
+index updates invalidate cached results automatically (see
+`Database.get_revision` for limits of older Xapian bindings).
+"""
+import threading
+
+from django.utils.hashcompat import md5_constructor
+
+class LRUCache(object):
+    """
+    In-process cache keeping at most `size` recently used results
+    """
+    def __init__(self, size=1000):
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._map = {}
+        # Circular doubly linked list of [prev, next, key, value] entries,
+        # most recently used entry goes right before the root
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            try:
+                link = self._map[key]
+            except KeyError:
+                return None
+
+            self._unlink(link)
+            self._append(link)
+
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            try:
+                link = self._map[key]
+            except KeyError:
+                link = self._map[key] = [None, None, key, value]
+            else:
+                link[3] = value
+                self._unlink(link)
+
+            self._append(link)
+
+            while len(self._map) > self.size:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._map[oldest[2]]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map.clear()
+            self._root[:] = [self._root, self._root, None, None]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._map)
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0], link[1] = last, self._root
+        last[1] = self._root[0] = link
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1], next[0] = next, prev
+
+class DjangoCache(object):
+    """
+    Cache stored with Django cache framework (so it may be shared between
+    processes)
+    """
+    def __init__(self, timeout=None, prefix="djapian"):
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def get(self, key):
+        from django.core.cache import cache
+        return cache.get(self._make_key(key))
+
+    def set(self, key, value):
+        from django.core.cache import cache
+
+        if self.timeout is None:
+            cache.set(self._make_key(key), value)
+        else:
+            cache.set(self._make_key(key), value, self.timeout)
+
+    def _make_key(self, key):
+        # Backends like memcached don't accept long keys or keys with spaces
+        return "%s:%s" % (self.prefix, md5_constructor(repr(key)).hexdigest())
@@ -1,37 +1,352 @@
 import os
+import time
+import zlib
+import shutil
+import tempfile
+import threading
+import subprocess
 import xapian
 
 from django.conf import settings
+from django.utils.encoding import smart_str
+
+class DatabasePool(object):
+    """
+    Keeps long-lived read-only database handles so searches don't have to
+    open the database (and re-read btree roots) on every query.
+    Handles are kept per thread because Xapian objects are not thread-safe.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._generations = {}
+
+    def get(self, paths, factory, locations=None):
+        """
+        Returns handle for given tuple of database paths creating it with
+        `factory` if needed. Handle is reopened on each access which is
+        a no-op in Xapian unless revision on disk has changed.
+        Handle is also recreated when `locations` (directories the databases
+        are actually stored in, see `get_location`) change.
+        """
+        handles = self._get_handles()
+
+        frozen = getattr(self._local, "frozen", 0)
+        if frozen and paths in self._local.fresh:
+            return handles[paths][0]
+
+        generation = [
+            (self._generations.get(path, 0), location)
+            for path, location in zip(paths, locations or paths)
+        ]
+
+        try:
+            database, handle_generation = handles[paths]
+        except KeyError:
+            database = None
+        else:
+            if handle_generation != generation:
+                database = None
+            else:
+                try:
+                    database.reopen()
+                except (xapian.DatabaseError, RuntimeError):
+                    database = None
+
+        if database is None:
+            database = factory()
+            handles[paths] = (database, generation)
+
+        if frozen:
+            self._local.fresh.add(paths)
+
+        return database
+
+    def freeze(self):
+        """
+        Keeps handles of current thread at revision they have on their next
+        access (instead of reopening them every time) until `thaw()`,
+        so several searches see one snapshot of the database
+        """
+        frozen = getattr(self._local, "frozen", 0)
+        if not frozen:
+            self._local.fresh = set()
+        self._local.frozen = frozen + 1
+
+    def thaw(self):
+        self._local.frozen -= 1
+
+    def discard(self, path):
+        """
+        Invalidates all handles (in all threads) which use given path
+        """
+        self._generations[path] = self._generations.get(path, 0) + 1
+
+        handles = self._get_handles()
+        for paths in handles.keys():
+            if path in paths:
+                del handles[paths]
+
+        for paths in list(getattr(self._local, "fresh", ())):
+            if path in paths:
+                self._local.fresh.remove(paths)
+
+    def _get_handles(self):
+        try:
+            return self._local.handles
+        except AttributeError:
+            self._local.handles = {}
+            return self._local.handles
+
+pool = DatabasePool()
+
+def get_location(path):
+    """
+    Returns directory database configured at `path` is stored in: target
+    of "`path`.current" symlink left by `swap_directory` or `path` itself
+    """
+    current = path + ".current"
+    if os.path.islink(current):
+        return os.path.realpath(current)
+    return path
+
+def remove_directory(path):
+    """
+    Removes database directory together with directory swapped in for it
+    """
+    current = path + ".current"
+    if os.path.islink(current):
+        target = os.path.realpath(current)
+        os.remove(current)
+        shutil.rmtree(target, ignore_errors=True)
+
+    shutil.rmtree(path, ignore_errors=True)
+
+def swap_directory(path, target):
+    """
+    Atomically makes database configured at `path` use `target` directory
+    (which should be in the same parent directory) by replacing
+    "`path`.current" symlink, and removes directory used before. `path`
+    itself is never moved, so database is never missing. Processes which
+    have the database opened keep reading old files until they reopen it.
+    """
+    old = get_location(path)
+
+    link = "%s.link-%d" % (path, os.getpid())
+    if os.path.islink(link):
+        os.remove(link)
+    # Relative link keeps working if index directory is moved
+    os.symlink(os.path.basename(target), link)
+    os.rename(link, path + ".current")
+
+    if old != os.path.realpath(target):
+        shutil.rmtree(old, ignore_errors=True)
+
+def make_shadow_directory(path):
+    """
+    Creates empty directory next to `path` to build its replacement in
+    """
+    parent = os.path.dirname(path)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    return tempfile.mkdtemp(prefix="%s." % os.path.basename(path), dir=parent)
+
+def get_directory_size(path):
+    """
+    Returns total size of files under `path` in bytes
+    """
+    size = 0
+    for root, dirs, files in os.walk(os.path.realpath(path)):
+        for file_name in files:
+            size += os.path.getsize(os.path.join(root, file_name))
+    return size
+
+def retry_locked(func, timeout=None, interval=0.5):
+    """
+    Calls `func` which opens writable databases until it stops failing
+    because another writer holds the lock, but no longer than `timeout`
+    seconds (`DJAPIAN_LOCK_TIMEOUT` setting, 60 by default). Xapian locks
+    don't block, so writers which may run concurrently (the daemon and
+    compaction) wait with this.
+    """
+    if timeout is None:
+        timeout = getattr(settings, "DJAPIAN_LOCK_TIMEOUT", 60)
+    deadline = time.time() + timeout
+
+    while True:
+        try:
+            return func()
+        except xapian.DatabaseLockError:
+            if time.time() >= deadline:
+                raise
+            time.sleep(interval)
+
+def compact_database(db):
+    """
+    Replaces `db` with its compacted copy. The copy is made without the
+    write lock, which is taken only to swap it in (waiting for current
+    writer, see `retry_locked`). If the database has been written to
+    meanwhile, the copy is made again with the lock held, so no update is
+    lost. The index daemon doesn't write to databases compacted by the
+    index command, so it doesn't force that.
+    """
+    revision = db.get_revision()
+
+    shadow = db.create_shadow()
+    try:
+        try:
+            shadow.merge([db.get_location()])
+        except (xapian.DatabaseModifiedError, subprocess.CalledProcessError):
+            # Database has changed too much to be read till the end
+            revision = None
+
+        writers = retry_locked(db._lock)
+
+        if revision is None or db.get_revision() != revision:
+            shadow.merge([db.get_location()])
+    except:
+        shadow.clear()
+        raise
+
+    db.swap(shadow)
+
+    # Release the write lock
+    del writers
+
+def compact(sources, destination):
+    """
+    Merges databases at `sources` paths into new compacted database at
+    `destination` (which must not exist yet). Document ids are renumbered,
+    so documents should only be addressed by their UID terms afterwards.
+    """
+    if hasattr(xapian.Database, "compact"):
+        # Xapian 1.3.4+ can compact without external tools
+        database = xapian.Database()
+        for source in sources:
+            database.add_database(xapian.Database(source))
+        database.compact(destination)
+    else:
+        command = getattr(settings, "DJAPIAN_XAPIAN_COMPACT", "xapian-compact")
+        output = open(os.devnull, "w")
+        try:
+            subprocess.check_call(
+                [command] + list(sources) + [destination],
+                stdout=output
+            )
+        finally:
+            output.close()
+
+class Registry(object):
+    """
+    Maps model names and indexer descriptors of documents stored in one
+    database to small integers, so documents store compact packed ids
+    instead of full names. The mapping is kept in database metadata.
+    """
+    models_key = "djapian:models"
+    indexers_key = "djapian:indexers"
+    filter_terms_key = "djapian:filter_terms"
+
+    def __init__(self, models=(), indexers=(), legacy=False, filter_terms=False):
+        self.models = list(models)
+        self.indexers = list(indexers)
+        # Database filled before registry existed keeps full names
+        self.legacy = legacy
+        # All documents have filter terms of tag values (see
+        # `Field.get_filter_term`), otherwise exact lookups can't use them
+        self.filter_terms = filter_terms
+
+    @classmethod
+    def load(cls, database):
+        models = database.get_metadata(cls.models_key)
+        indexers = database.get_metadata(cls.indexers_key)
+
+        return cls(
+            models and models.split("\n") or (),
+            indexers and indexers.split("\n") or (),
+            legacy=not models and database.get_doccount() > 0,
+            filter_terms=database.get_metadata(cls.filter_terms_key) == "1"
+        )
+
+    def enable_filter_terms(self, database):
+        """
+        Marks writable `database` as one whose documents all have filter
+        terms, it should be empty
+        """
+        database.set_metadata(self.filter_terms_key, "1")
+        self.filter_terms = True
+
+    def register(self, database, model_name, descriptor):
+        """
+        Returns ids of given model and indexer storing new ones in
+        writable `database`
+        """
+        return (
+            self._register(database, self.models, self.models_key, model_name),
+            self._register(database, self.indexers, self.indexers_key, descriptor),
+        )
+
+    def lookup(self, model_name, descriptor):
+        """
+        Returns packed ids of given model and indexer or None if they are
+        not registered
+        """
+        try:
+            return self.pack(
+                self.models.index(model_name),
+                self.indexers.index(descriptor)
+            )
+        except ValueError:
+            return None
+
+    def pack(self, model_id, indexer_id):
+        return "%x:%x" % (model_id, indexer_id)
+
+    def unpack(self, value):
+        model_id, indexer_id = value.split(":", 1)
+        return int(model_id, 16), int(indexer_id, 16)
+
+    def _register(self, database, names, key, name):
+        try:
+            return names.index(name)
+        except ValueError:
+            names.append(name)
+            database.set_metadata(key, "\n".join(names))
+            return len(names) - 1
 
 class Database(object):
     def __init__(self, path):
         self._path = path
+        self._registry = None
 
     def open(self, write=False):
         """
         Opens database for manipulations
         """
-        if not os.path.exists(self._path):
-            os.makedirs(self._path)
-
         if write:
+            location = self.get_location()
+            if not os.path.exists(location):
+                os.makedirs(location)
+
             database = xapian.WritableDatabase(
-                self._path,
+                location,
                 xapian.DB_CREATE_OR_OPEN,
             )
         else:
-            try:
-                database = xapian.Database(self._path)
-            except xapian.DatabaseOpeningError:
-                self.create_database()
-
-                database = xapian.Database(self._path)
+            database = pool.get(
+                self.get_paths(),
+                self._open_readonly,
+                self.get_locations()
+            )
 
         return database
 
     def create_database(self):
+        location = self.get_location()
+        if not os.path.exists(location):
+            os.makedirs(location)
+
         database = xapian.WritableDatabase(
-            self._path,
+            location,
             xapian.DB_CREATE_OR_OPEN,
         )
         del database
@@ -39,33 +354,340 @@ class Database(object):
     def document_count(self):
         return self.open().get_doccount()
 
+    def get_revision(self):
+        """
+        Returns value which changes with every commit to the database.
+        Bindings without `Database.get_revision()` make it out of document
+        count, last document id and sizes and modification times of the
+        files. It costs a directory listing on each call, and commits
+        made within one tick of file system clock which keep the counts
+        and sizes may be missed, so caches (see `djapian.cache`) should
+        have a timeout with such bindings.
+        """
+        database = self.open()
+
+        try:
+            return database.get_revision()
+        except AttributeError:
+            # Bindings without Database.get_revision(): use state of files
+            stamp = []
+            location = self.get_location()
+            for file_name in sorted(os.listdir(location)):
+                stat = os.stat(os.path.join(location, file_name))
+                stamp.append((file_name, stat.st_mtime, stat.st_size))
+            return (database.get_doccount(), database.get_lastdocid(), tuple(stamp))
+
+    def get_registry(self, docid=None, refresh=False):
+        """
+        Returns registry of database which holds document with given id
+        """
+        if self._registry is None or refresh:
+            self._registry = Registry.load(self.open())
+        return self._registry
+
+    def has_filter_terms(self):
+        return self.get_registry().filter_terms
+
     def clear(self):
+        self._invalidate()
+        remove_directory(self._path)
+
+    def create_shadow(self):
+        """
+        Returns new empty database of the same layout next to this one,
+        it may be built while this database is used and then swapped in
+        """
+        return self.with_path(make_shadow_directory(self._path))
+
+    def swap(self, shadow):
+        """
+        Replaces the database with `shadow` database (see `create_shadow`).
+        Readers move over to the new database on their next access.
+        """
+        swap_directory(self._path, shadow.get_location())
+        self._invalidate()
+
+    def compact(self):
+        """
+        Compacts the database (see `compact_database`)
+        """
+        compact_database(self)
+
+    def get_size(self):
+        return get_directory_size(self.get_location())
+
+    def merge(self, sources):
+        """
+        Replaces content of the database with compacted union of databases
+        at `sources` paths
+        """
+        self.clear()
+
+        location = self.get_location()
+        parent = os.path.dirname(location)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+        compact(sources, location)
+
+    def with_path(self, path):
+        """
+        Returns database of the same layout stored at another path
+        """
+        return self.__class__(path)
+
+    def get_paths(self):
+        return (self._path,)
+
+    def get_location(self):
+        return get_location(self._path)
+
+    def get_locations(self):
+        return (self.get_location(),)
+
+    def _invalidate(self):
+        pool.discard(self._path)
+        self._registry = None
+
+    def _lock(self):
+        return [self.open(write=True)]
+
+    def _open_readonly(self):
+        location = self.get_location()
+
         try:
-            for file_path in os.listdir(self._path):
-                os.remove(os.path.join(self._path, file_path))
+            database = xapian.Database(location)
+        except xapian.DatabaseOpeningError:
+            self.create_database()
 
-            os.rmdir(self._path)
-        except OSError:
-            pass
+            database = xapian.Database(location)
+
+        return database
 
 class CompositeDatabase(Database):
     def __init__(self, dbs):
         self._dbs = dbs
+        self._leaves = None
 
     def open(self, write=False):
         if write:
             raise ValueError("Composite database cannot be opened for writing")
 
-        base = self._dbs[0]
-        raw = base.open()
+        return pool.get(
+            self.get_paths(),
+            self._open_readonly,
+            self.get_locations()
+        )
+
+    def create_database(self):
+        raise NotImplementedError
+
+    def get_revision(self):
+        return tuple([db.get_revision() for db in self._dbs])
+
+    def get_registry(self, docid=None, refresh=False):
+        # Xapian interleaves document ids of combined databases
+        leaves = self.get_leaves()
+        leaf = leaves[(docid - 1) % len(leaves)]
+
+        return leaf.get_registry(refresh=refresh)
+
+    def has_filter_terms(self):
+        for leaf in self.get_leaves():
+            if not leaf.has_filter_terms():
+                return False
+        return True
+
+    def get_leaves(self):
+        if self._leaves is None:
+            leaves = []
+            for db in self._dbs:
+                if isinstance(db, CompositeDatabase):
+                    leaves.extend(db.get_leaves())
+                else:
+                    leaves.append(db)
+            self._leaves = leaves
+        return self._leaves
+
+    def clear(self):
+        raise NotImplementedError
+
+    def merge(self, sources):
+        raise NotImplementedError
+
+    def create_shadow(self):
+        raise NotImplementedError
+
+    def swap(self, shadow):
+        raise NotImplementedError
+
+    def compact(self):
+        raise NotImplementedError
 
-        for db in self._dbs[1:]:
-            raw.add_database(db.open())
+    def get_size(self):
+        return sum([db.get_size() for db in self._dbs])
+
+    def get_paths(self):
+        paths = ()
+        for db in self._dbs:
+            paths += db.get_paths()
+        return paths
+
+    def get_locations(self):
+        locations = ()
+        for db in self._dbs:
+            locations += db.get_locations()
+        return locations
+
+    def _invalidate(self):
+        for db in self.get_leaves():
+            db._invalidate()
+
+    def _open_readonly(self):
+        # Build a fresh handle: adding sub-databases to one of the pooled
+        # member handles would change it for every other user of the pool
+        raw = xapian.Database()
+
+        for db in self._dbs:
+            raw.add_database(db._open_readonly())
 
         return raw
 
+class ShardedDatabase(CompositeDatabase):
+    """
+    Database split into `shards` sub-databases (stored as `shard-N`
+    directories under `path`). Documents are routed to shards by hash of
+    their primary key, searches span all of the shards.
+    """
+    def __init__(self, path, shards):
+        self._path = path
+        super(ShardedDatabase, self).__init__([
+            Shard(self, number) for number in range(shards)
+        ])
+
+    def open(self, write=False):
+        if write:
+            return ShardedWriter(self)
+
+        return super(ShardedDatabase, self).open()
+
+    def get_shard_number(self, pk):
+        # Objects from change log come with string ids, so hash string form
+        return (zlib.crc32(smart_str(pk)) & 0xffffffff) % len(self._dbs)
+
+    def get_shard(self, pk):
+        return self._dbs[self.get_shard_number(pk)]
+
+    def get_shards(self):
+        return self._dbs
+
     def create_database(self):
-        raise NonImplementedError
+        # Shards are created lazily on first write otherwise
+        for db in self._dbs:
+            db.create_database()
+
+    def with_path(self, path):
+        return self.__class__(path, len(self._dbs))
 
     def clear(self):
-        raise NotImplementedError
+        self._invalidate()
+        remove_directory(self._path)
+
+    def create_shadow(self):
+        return self.with_path(make_shadow_directory(self._path))
+
+    def swap(self, shadow):
+        # Whole database is swapped, so all shards switch at once
+        swap_directory(self._path, shadow.get_location())
+        self._invalidate()
+
+    def get_location(self):
+        return get_location(self._path)
+
+    def compact(self):
+        compact_database(self)
+
+    def merge(self, sources):
+        """
+        Merges sharded databases of the same shard count shard by shard
+        """
+        for number, db in enumerate(self._dbs):
+            db.merge([
+                os.path.join(source, "shard-%d" % number) for source in sources
+            ])
+
+    def _lock(self):
+        return [db.open(write=True) for db in self._dbs]
+
+class Shard(Database):
+    """
+    Shard of `ShardedDatabase`, it is stored inside of location of the
+    whole database
+    """
+    def __init__(self, sharded, number):
+        Database.__init__(self, os.path.join(sharded._path, "shard-%d" % number))
+        self._sharded = sharded
+
+    def get_location(self):
+        return os.path.join(
+            self._sharded.get_location(),
+            os.path.basename(self._path)
+        )
+
+    def clear(self):
+        self._invalidate()
+        shutil.rmtree(self.get_location(), ignore_errors=True)
+
+class ShardedWriter(object):
+    """
+    Writable counterpart of `ShardedDatabase`. Shards are opened (and
+    locked, waiting for other writers with `retry_locked`) on first use,
+    so writers touching different shards don't block each other. Flushes
+    and transactions are applied to all opened shards.
+    """
+    def __init__(self, database):
+        self._database = database
+        self._shards = {}
+        self._transaction = None
+
+    def get_shard(self, pk):
+        """
+        Returns writable database of the shard which stores object with
+        given primary key
+        """
+        number = self._database.get_shard_number(pk)
+
+        try:
+            return self._shards[number]
+        except KeyError:
+            db = self._database.get_shards()[number]
+            shard = retry_locked(lambda: db.open(write=True))
+            if self._transaction is not None:
+                shard.begin_transaction(flush=self._transaction)
+            self._shards[number] = shard
+            return shard
+
+    def flush(self):
+        for shard in self._shards.values():
+            shard.flush()
+
+    def close(self):
+        """
+        Releases locks of opened shards. Xapian flushes their changes.
+        """
+        self._shards = {}
+
+    def begin_transaction(self, flush=True):
+        for shard in self._shards.values():
+            shard.begin_transaction(flush=flush)
+        self._transaction = flush
+
+    def commit_transaction(self):
+        self._transaction = None
+        for shard in self._shards.values():
+            shard.commit_transaction()
+
+    def cancel_transaction(self):
+        self._transaction = None
+        for shard in self._shards.values():
+            shard.cancel_transaction()
@@ -4,7 +4,7 @@ import re
 import xapian
 
 from django.db import models
-from django.utils.functional import curry
+from django.utils.encoding import smart_str
 
 class X(models.Q):
     pass
@@ -16,6 +16,139 @@ endswith = lambda a, b: a.endswith(b)
 regex = lambda a, b: re.match(b, a) is not None
 iregex = lambda a, b: re.match(b, a, re.I) is not None
 
+# Lookups which Xapian can evaluate natively
+QUERY_LOOKUPS = ('exact', 'in', 'gt', 'gte', 'lt', 'lte')
+
+def split_lookup(lookup):
+    if '__' in lookup:
+        return lookup.split('__', 1)
+    return lookup, 'exact'
+
+def apply_filters(query, model, tags, filter, exclude, filter_terms=True):
+    """
+    Turns parts of `filter` and `exclude` which Xapian can evaluate by itself
+    into boolean filter and value range queries applied to `query`.
+    Exact lookups use filter terms only if database has them
+    (`filter_terms`).
+    Returns the resulting query and the `filter` and `exclude` parts left for
+    the match decider.
+    """
+    tags = dict([(t.prefix, t) for t in tags])
+
+    if filter:
+        if filter.connector == 'AND' and not filter.negated:
+            children, filter = filter.children, X()
+        else:
+            children, filter = [filter], X()
+
+        for child in children:
+            compiled = _compile_node(child, model, tags, filter_terms)
+
+            if compiled is None:
+                filter.children.append(child)
+            else:
+                child_query, negated = compiled
+                if negated:
+                    query = xapian.Query(xapian.Query.OP_AND_NOT, query, child_query)
+                else:
+                    query = xapian.Query(xapian.Query.OP_FILTER, query, child_query)
+
+    if exclude:
+        compiled = _compile_node(exclude, model, tags, filter_terms)
+
+        if compiled is not None:
+            exclude_query, negated = compiled
+            if negated:
+                query = xapian.Query(xapian.Query.OP_FILTER, query, exclude_query)
+            else:
+                query = xapian.Query(xapian.Query.OP_AND_NOT, query, exclude_query)
+            exclude = X()
+
+    return query, filter, exclude
+
+def _compile_node(node, model, tags, filter_terms=True):
+    """
+    Returns pair of query and negation flag for given `X` tree or lookup
+    or None if it can't be expressed as a query
+    """
+    if not isinstance(node, X):
+        query = _compile_lookup(node[0], node[1], model, tags, filter_terms)
+        if query is None:
+            return None
+        return query, False
+
+    positive, negative = [], []
+
+    for child in node.children:
+        compiled = _compile_node(child, model, tags, filter_terms)
+        if compiled is None:
+            return None
+
+        child_query, negated = compiled
+        if negated:
+            negative.append(child_query)
+        else:
+            positive.append(child_query)
+
+    if not positive:
+        # Pure negations would need to match all documents first
+        return None
+
+    if node.connector == 'OR':
+        if negative:
+            return None
+        query = xapian.Query(xapian.Query.OP_OR, positive)
+    else:
+        query = xapian.Query(xapian.Query.OP_AND, positive)
+        if negative:
+            query = xapian.Query(
+                xapian.Query.OP_AND_NOT,
+                query,
+                xapian.Query(xapian.Query.OP_OR, negative)
+            )
+
+    return query, node.negated
+
+def _compile_lookup(lookup, value, model, tags, filter_terms=True):
+    field, op = split_lookup(lookup)
+
+    if op not in QUERY_LOOKUPS or field not in tags:
+        return None
+
+    tag = tags[field]
+
+    if op in ('exact', 'in'):
+        if not filter_terms:
+            return None
+        if op == 'exact':
+            values = [value]
+        elif isinstance(value, (list, tuple)) and value:
+            values = value
+        else:
+            return None
+
+        terms = [tag.get_filter_term(tag.convert(v, model)) for v in values]
+        if None in terms:
+            return None
+
+        return xapian.Query(xapian.Query.OP_OR, terms)
+
+    value = smart_str(tag.convert(value, model))
+
+    if op in ('gt', 'gte'):
+        query = xapian.Query(xapian.Query.OP_VALUE_GE, tag.number, value)
+    else:
+        query = xapian.Query(xapian.Query.OP_VALUE_LE, tag.number, value)
+
+    if op in ('gt', 'lt'):
+        query = xapian.Query(
+            xapian.Query.OP_AND_NOT,
+            query,
+            xapian.Query(xapian.Query.OP_VALUE_RANGE, tag.number, value, value)
+        )
+
+    return query
+
 class CompositeDecider(xapian.MatchDecider):
     # operators map
     op_map = {
@@ -41,72 +174,96 @@ class CompositeDecider(xapian.MatchDecider):
         'lte': operator.le,
     }
 
+    # case insensitive operators and their case sensitive versions
+    insensitive_op_map = {
+        'iexact': 'exact',
+        'istartswith': 'startswith',
+        'iendswith': 'endswith',
+        'icontains': 'contains',
+    }
+
     def __init__(self, model, tags, filter, exclude):
         xapian.MatchDecider.__init__(self)
 
         self._model = model
         self._tags = tags
+        self._tags_map = dict([(t.number, t) for t in tags])
         self._values_map = dict([(t.prefix, t.number) for t in tags])
         self._filter = filter
         self._exclude = exclude
 
+        # Lookup trees are compiled to closures once per query so that only
+        # value fetching and comparison are done per document
+        self._filter_test = filter and self._compile_x(filter) or None
+        self._exclude_test = exclude and self._compile_x(exclude) or None
+
     def __call__(self, document):
-        if self._filter and not self._do_x(self._filter, document):
+        if self._filter_test is not None and not self._filter_test(document):
             return False
 
-        if self._exclude and self._do_x(self._exclude, document):
+        if self._exclude_test is not None and self._exclude_test(document):
             return False
 
         return True
 
     def get_tag(self, index):
-        for tag in self._tags:
-            if tag.number == index:
-                return tag
-        raise ValueError("No tag with number '%s'" % index)
+        try:
+            return self._tags_map[index]
+        except KeyError:
+            raise ValueError("No tag with number '%s'" % index)
 
-    def _do_x(self, field, document):
+    def _compile_x(self, field):
+        tests = []
         for child in field.children:
             if isinstance(child, X):
-                result = self._do_x(child, document)
+                tests.append(self._compile_x(child))
             else:
-                result = self._do_field(child[0], child[1], document)
+                tests.append(self._compile_field(child[0], child[1]))
 
-            if (result and field.connector == 'OR')\
-                or (not result and field.connector == 'AND'):
-                break
+        is_or = field.connector == 'OR'
+        negated = field.negated
 
-        if field.negated:
-            return not result
-        else:
-            return result
+        def test(document):
+            for child_test in tests:
+                if child_test(document):
+                    if is_or:
+                        return not negated
+                elif not is_or:
+                    return negated
 
-    def _do_field(self, lookup, value, document):
-        if '__' in lookup:
-            field, op = lookup.split('__', 1)
-        else:
-            field, op = lookup, 'exact'
+            return is_or == negated
 
-        if op not in self.op_map:
-            raise ValueError("Unknown lookup operator '%s'" % op)
+        return test
 
-        op = self.op_map[op]
+    def _compile_field(self, lookup, value):
+        field, op = split_lookup(lookup)
 
-        doc_value = document.get_value(self._values_map[field])
+        if op not in self.op_map:
+            raise ValueError("Unknown lookup operator '%s'" % op)
 
-        convert = curry(
-            self.get_tag(self._values_map[field]).convert,
-            model=self._model
-        )
+        valueno = self._values_map[field]
+        tag = self.get_tag(valueno)
+        convert = lambda value: smart_str(tag.convert(value, self._model))
 
         if isinstance(value, (list, tuple)):
             value = map(convert, value)
         else:
             value = convert(value)
 
-        operands = [
-            doc_value,
-            value,
-        ]
+        if op == 'in':
+            if isinstance(value, list):
+                value = set(value)
+            return lambda document: document.get_value(valueno) in value
+
+        if op in ('regex', 'iregex'):
+            flags = op == 'iregex' and re.I or 0
+            match = re.compile(value, flags).match
+            return lambda document: match(document.get_value(valueno)) is not None
+
+        if op in self.insensitive_op_map:
+            compare = self.op_map[self.insensitive_op_map[op]]
+            value = value.lower()
+            return lambda document: compare(document.get_value(valueno).lower(), value)
 
-        return reduce(op, operands)
+        compare = self.op_map[op]
+        return lambda document: compare(document.get_value(valueno), value)
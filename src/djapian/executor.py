@@ -0,0 +1,131 @@
+"""
+Bounded pool of threads to run searches in background. Each thread keeps
+its own Xapian handles (see `djapian.database.DatabasePool`). Django
+database connection of a thread is closed after each call, so it is not
+left idle in a transaction.
+"""
+import sys
+import Queue
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+class Future(object):
+    """
+    Result of a call which runs in a pool thread
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """
+        Waits for the call to finish and returns its result or raises
+        its exception
+        """
+        self._done.wait(timeout)
+
+        if not self.done():
+            raise RuntimeError("Call has not finished in %s seconds" % timeout)
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+    def add_done_callback(self, callback):
+        """
+        Calls `callback` with the future when it is done (right away if it
+        is done already). Callbacks run in the pool thread.
+        """
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+
+        callback(self)
+
+    def _finish(self, result=None, exc_info=None):
+        self._lock.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+
+        for callback in callbacks:
+            callback(self)
+
+class Executor(object):
+    """
+    Runs calls in at most `size` threads which are started on demand
+    """
+    def __init__(self, size):
+        self.size = size
+
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        self._start_thread()
+        return future
+
+    def _start_thread(self):
+        self._lock.acquire()
+        try:
+            if len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            future, func, args, kwargs = self._queue.get()
+
+            try:
+                try:
+                    result = func(*args, **kwargs)
+                except:
+                    future._finish(exc_info=sys.exc_info())
+                else:
+                    future._finish(result)
+            finally:
+                # Implicit transaction (and its snapshot on e.g. MySQL)
+                # must not outlive the call
+                connection.close()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """
+    Returns shared executor of `DJAPIAN_SEARCH_THREADS` threads
+    """
+    global _executor
+
+    _executor_lock.acquire()
+    try:
+        if _executor is None:
+            _executor = Executor(getattr(settings, "DJAPIAN_SEARCH_THREADS", 4))
+        return _executor
+    finally:
+        _executor_lock.release()
@@ -1,27 +1,107 @@
 import datetime
+import calendar
 import os
+import logging
+import threading
 
 from django.db import models
+from django.db.models.query import QuerySet
 from django.utils.itercompat import is_iterable
 from djapian.signals import post_save, pre_delete
 from django.conf import settings
-from django.utils.encoding import smart_unicode
+from django.utils.encoding import smart_unicode, smart_str
 
-from djapian.resultset import ResultSet, ResultRelatedSet
-from djapian import utils, decider
+from djapian.resultset import ResultSet, AsyncResultSet, ResultRelatedSet
+from djapian.database import Registry, ShardedWriter
+from djapian import utils, decider, timing
 
 import xapian
 
+logger = logging.getLogger("djapian.indexer")
+
+# Paths of indexes which were reported to lack filter terms
+_without_filter_terms = set()
+
+def sortable(serialise):
+    """
+    Makes "sortable" value format converter out of given serialiser
+    """
+    def converter(value):
+        if value is None:
+            return None
+        return serialise(value)
+    return converter
+
+def serialise_datetime(value):
+    return xapian.sortable_serialise(
+        calendar.timegm(value.timetuple()) + value.microsecond / 1000000.0
+    )
+
+def serialise_date(value):
+    return xapian.sortable_serialise(calendar.timegm(value.timetuple()))
+
+def unserialise_datetime(value):
+    return datetime.datetime.utcfromtimestamp(xapian.sortable_unserialise(value))
+
 class Field(object):
     raw_types = (int, long, float, basestring, bool, models.Model,
                  datetime.time, datetime.date, datetime.datetime)
 
+    # Index value converters: (model field or value types, converter)
+    converters = (
+        #
+        # Integer fields are stored with 12 leading zeros
+        #
+        ((models.IntegerField, int, long), lambda value: '%012d' % value),
+        #
+        # Boolean fields are stored as 't' or 'f'
+        #
+        ((models.BooleanField, bool), lambda value: value and 't' or 'f'),
+        #
+        # DateTime fields are stored as %Y%m%d%H%M%S (better
+        # sorting)
+        #
+        ((models.DateTimeField, datetime.datetime),
+            lambda value: value.strftime('%Y%m%d%H%M%S')),
+        ((float, models.FloatField), lambda value: '%.10f' % value),
+    )
+
+    # Converters of "sortable" value format for model fields: numbers and
+    # dates are stored with `xapian.sortable_serialise` which keeps their
+    # order (negative numbers included) as plain string comparison.
+    # (model field types, converter, decoder)
+    sortable_converters = (
+        (models.BooleanField, lambda value: value and 't' or 'f', None),
+        (models.IntegerField, sortable(xapian.sortable_serialise),
+            lambda value: int(round(xapian.sortable_unserialise(value)))),
+        (models.FloatField, sortable(xapian.sortable_serialise),
+            xapian.sortable_unserialise),
+        (models.DateTimeField, sortable(serialise_datetime), unserialise_datetime),
+        (models.DateField, sortable(serialise_date),
+            lambda value: unserialise_datetime(value).date()),
+    )
+
     def __init__(self, path, weight=utils.DEFAULT_WEIGHT, prefix="", number=None):
         self.path = path
         self.weight = weight
         self.prefix = prefix
         self.number = number
 
+        self._resolver = self._get_resolver()
+        self._model = None
+        self._value_format = "string"
+        self._converter = None
+        self._decoder = None
+
+    def compile(self, model, value_format="string"):
+        """
+        Prepares converter for values of this field in given model, so
+        that it doesn't need to inspect model metadata on every call
+        """
+        self._model = model
+        self._value_format = value_format
+        self._converter, self._decoder = self._get_converter(model, value_format)
+
     def get_tag(self):
         return self.prefix.upper()
 
@@ -29,52 +109,15 @@ class Field(object):
         """
         Generates index values (for sorting) for given field value and its content type
         """
-        # If it is a model field make some postprocessing of its value
-        try:
-            content_type = model._meta.get_field(self.path.split('.', 1)[0])
-        except models.FieldDoesNotExist:
-            content_type = field_value
-
-        value = field_value
-
-        if isinstance(content_type, (models.IntegerField, int, long)):
-            #
-            # Integer fields are stored with 12 leading zeros
-            #
-            value = '%012d' % field_value
-        elif isinstance(content_type, (models.BooleanField, bool)):
-            #
-            # Boolean fields are stored as 't' or 'f'
-            #
-            if field_value:
-                value = 't'
-            else:
-                value = 'f'
-        elif isinstance(content_type, (models.DateTimeField, datetime.datetime)):
-            #
-            # DateTime fields are stored as %Y%m%d%H%M%S (better
-            # sorting)
-            #
-            value = field_value.strftime('%Y%m%d%H%M%S')
-        elif isinstance(content_type, (float, models.FloatField)):
-            value = '%.10f' % value
+        if model is self._model:
+            converter = self._converter
+        else:
+            converter = self._get_converter(model, self._value_format)[0]
 
-        return value
+        return converter(field_value)
 
     def resolve(self, value):
-        bits = self.path.split(".")
-
-        for bit in bits:
-            try:
-                value = getattr(value, bit)
-            except AttributeError:
-                raise
-
-            if callable(value):
-                try:
-                    value = value()
-                except TypeError:
-                    raise
+        value = self._resolver(value)
 
         if isinstance(value, self.raw_types):
             return value
@@ -84,22 +127,107 @@ class Field(object):
             return ", ".join(value.all())
         return None
 
+    def get_filter_term(self, index_value):
+        """
+        Returns boolean term used to filter by exact index value
+        or None if value is too long to be stored as a term
+        """
+        term = "XV%s:%s" % (self.get_tag(), smart_str(index_value))
+
+        if len(term) > utils.MAX_TERM_LENGTH:
+            return None
+        return term
+
     def extract(self, document):
         if self.number:
-            return document.get_value(self.number)
+            return self.decode(document.get_value(self.number))
 
         return None
 
+    def decode(self, value):
+        """
+        Converts stored index value back to Python value if its format
+        allows that
+        """
+        if value and self._decoder is not None:
+            return self._decoder(value)
+        return value
+
+    def _get_resolver(self):
+        bits = self.path.split(".")
+
+        def resolver(value):
+            for bit in bits:
+                value = getattr(value, bit)
+
+                if callable(value):
+                    value = value()
+            return value
+
+        return resolver
+
+    def _get_converter(self, model, value_format="string"):
+        """
+        Returns converter and decoder (if any) of index values
+        """
+        # If it is a model field make some postprocessing of its value
+        try:
+            content_type = model._meta.get_field(self.path.split('.', 1)[0])
+        except models.FieldDoesNotExist:
+            # Dispatch on the type of each value. Such values can't be
+            # decoded later so they are always stored as strings
+            return self._convert_value, None
+
+        if value_format == "sortable":
+            for types, converter, decoder in self.sortable_converters:
+                if isinstance(content_type, types):
+                    return converter, decoder
+
+        for types, converter in self.converters:
+            if isinstance(content_type, types):
+                return converter, None
+
+        return (lambda value: value), None
+
+    def _convert_value(self, value):
+        for types, converter in self.converters:
+            if isinstance(value, types):
+                return converter(value)
+
+        return value
+
 def paginate(queue, page_size=1000):
-    from django.core.paginator import Paginator
-    paginator = Paginator(queue, page_size)
+    """
+    Iterates over queue. Querysets are walked in primary key order by
+    chunks of `page_size` objects using `pk > last_seen` conditions, so
+    each chunk costs the same regardless of how deep into the table it is.
+    """
+    if not isinstance(queue, QuerySet)\
+            or queue.query.low_mark or queue.query.high_mark is not None:
+        for obj in queue:
+            yield obj
+        return
+
+    pk_name = queue.model._meta.pk.name
+    queue = queue.order_by(pk_name)
+
+    last_pk = None
+    while True:
+        if last_pk is None:
+            page = queue
+        else:
+            page = queue.filter(**{"%s__gt" % pk_name: last_pk})
 
-    for num in paginator.page_range:
-        page = paginator.page(num)
+        page = list(page[:page_size])
 
-        for obj in page.object_list:
+        for obj in page:
             yield obj
 
+        if len(page) < page_size:
+            break
+
+        last_pk = page[-1].pk
+
 class Indexer(object):
     field_class = Field
     decider = decider.CompositeDecider
@@ -110,6 +238,15 @@ class Indexer(object):
     aliases = {}
     trigger = lambda indexer, obj: True
     stemming_lang_accessor = None
+    chunk_size = 1000
+    # Format of tag values: "string" or "sortable" (numbers and dates are
+    # stored as `xapian.sortable_serialise` strings). Existing index should
+    # be rebuilt with `index --rebuild` after changing it.
+    value_format = "string"
+    # Cache of search results (see djapian.cache), disabled by default
+    result_cache = None
+    # Number of shards to split index into (see `IndexSpace.add_index`)
+    shards = None
 
     def __init__(self, db, model):
         """
@@ -146,6 +283,12 @@ class Indexer(object):
             self.tags.append(self.field_class(path, weight, prefix=tag, number=valueno))
             valueno += 1
 
+        if self.value_format not in ("string", "sortable"):
+            raise ValueError("Unknown value format `%s`" % self.value_format)
+
+        for field in self.fields + self.tags:
+            field.compile(self._model, self.value_format)
+
         for tag, aliases in self.__class__.aliases.iteritems():
             if self.has_tag(tag):
                 if not isinstance(aliases, (list, tuple)):
@@ -177,23 +320,36 @@ class Indexer(object):
 
     # Public Indexer interface
 
-    def update(self, documents=None, after_index=None, transaction=False, flush=False):
+    def update(self, documents=None, after_index=None, transaction=False,
+               flush=False, database=None, chunk_size=None):
         """
         Update the database with the documents.
+        If writable `database` is given it is used instead of opening a new
+        one and the caller is responsible for flushing it.
+        Querysets are fetched by `chunk_size` objects (`Indexer.chunk_size`
+        by default).
         There are some default value and terms in a document:
          * Values:
            1. Used to store the ID of the document
-           2. Store the model of the object (in the string format, like
-              "project.app.model")
-           3. Store the indexer descriptor (module path)
-           4..10. Free
+           2. Store ids of the model and the indexer packed together
+              (see `djapian.database.Registry`)
+           3..10. Free
+
+           Databases created before the registry store the model string
+           (like "app.Model") in value 2 and the indexer descriptor in
+           value 3 until they are rebuilt.
 
          * Terms
            UID: Used to store the ID of the document, so we can replace
                 the document by the ID
         """
         # Open Xapian Database
-        database = self._db.open(write=True)
+        own_database = database is None
+        if own_database:
+            database = self._db.open(write=True)
+
+        # Registry ids of each shard written to
+        ids = {}
 
         # If doesnt have any document at all
         if documents is None:
@@ -223,12 +379,34 @@ class Indexer(object):
         else:
             begin = commit = cancel = lambda: None
 
+        # One generator serves the whole run, it is pointed to each new
+        # document (which also resets term positions)
+        generator = xapian.TermGenerator()
+        generator.set_flags(xapian.TermGenerator.FLAG_SPELLING)
+
+        fields = self.fields + self.tags
+
+        timer = timing.get_timer("update", indexer=self)
+        documents = 0
+
         # Get each document received
-        for obj in paginate(update_queue):
+        for obj in paginate(update_queue, chunk_size or self.chunk_size):
+            if timer is not None:
+                timer.lap("fetch")
+            documents += 1
+
+            # Kept out of the try below: failure to open (lock) a shard must
+            # not be mistaken for a broken document and skipped silently
+            shard, shard_ids = self._get_shard(database, obj, ids)
+
             begin()
             try:
-                if not self.trigger(obj):
-                    self.delete(obj.pk, database)
+                triggered = self.trigger(obj)
+                if timer is not None:
+                    timer.lap("trigger")
+
+                if not triggered:
+                    self._delete(obj.pk, shard, shard_ids)
                     commit()
                     continue
 
@@ -236,20 +414,17 @@ class Indexer(object):
                 #
                 # Add default terms and values
                 #
-                uid = self._create_uid(obj)
-                doc.add_term(self._create_uid(obj))
-                self._insert_meta_values(doc, obj)
+                uid = self._create_uid(obj, shard_ids)
+                doc.add_term(uid)
+                self._insert_meta_values(doc, obj, shard_ids)
 
-                generator = xapian.TermGenerator()
-                generator.set_database(database)
+                generator.set_database(shard)
                 generator.set_document(doc)
-                generator.set_flags(xapian.TermGenerator.FLAG_SPELLING)
+                generator.set_stemmer(
+                    utils.get_stemmer(self._get_stem_language(obj))
+                )
 
-                stem_lang = self._get_stem_language(obj)
-                if stem_lang:
-                    generator.set_stemmer(xapian.Stem(stem_lang))
-
-                for field in self.fields + self.tags:
+                for field in fields:
                     # Trying to resolve field value or skip it
                     try:
                         value = field.resolve(obj)
@@ -259,16 +434,25 @@ class Indexer(object):
                     if field.prefix:
                         index_value = field.convert(value, self._model)
                         if index_value is not None:
-                            doc.add_value(field.number, smart_unicode(index_value))
+                            doc.add_value(field.number, smart_str(index_value))
+
+                            term = field.get_filter_term(index_value)
+                            if term is not None:
+                                doc.add_term(term, 0)
 
                     prefix = smart_unicode(field.get_tag())
                     generator.index_text(smart_unicode(value), field.weight, prefix)
                     if prefix:  # if prefixed then also index without prefix
                         generator.index_text(smart_unicode(value), field.weight)
+                if timer is not None:
+                    timer.lap("fields")
 
-                database.replace_document(uid, doc)
+                shard.replace_document(uid, doc)
                 #FIXME: ^ may raise InvalidArgumentError when word in
                 #         text larger than 255 simbols
+                if timer is not None:
+                    timer.lap("write")
+
                 if after_index:
                     after_index(obj)
 
@@ -284,11 +468,27 @@ class Indexer(object):
                     database.flush()
                 else:
                     flush_each()
+            if timer is not None:
+                timer.lap("flush")
+
+        if own_database:
+            database.flush()
+            if timer is not None:
+                timer.lap("flush")
 
-        database.flush()
+        if timer is not None:
+            timer.info["documents"] = documents
+            timer.finish()
 
     def search(self, query):
         return ResultSet(self, query)
+
+    def asearch(self, query):
+        """
+        Same as `search` but results are fetched in background with
+        `fetch()` which returns a future (see `djapian.executor`)
+        """
+        return AsyncResultSet(self, query)
  
     def related(self, hits):
         return ResultRelatedSet(self, hits)
@@ -301,7 +501,23 @@ class Indexer(object):
         try:
             if database is None:
                 database = self._db.open(write=True)
-            database.delete_document(self._create_uid(obj))
+            if isinstance(database, ShardedWriter):
+                database = database.get_shard(self._get_pk(obj))
+
+            # Registry is only read, nothing is stored by deletion
+            registry = Registry.load(database)
+            if registry.legacy:
+                ids = None
+            else:
+                ids = registry.lookup(
+                    self._model_name,
+                    self.__class__.get_descriptor()
+                )
+                if ids is None:
+                    # No document of the indexer is in the database
+                    return
+
+            self._delete(obj, database, ids)
         except (IOError, RuntimeError, xapian.DocNotFoundError), e:
             pass
 
@@ -324,43 +540,100 @@ class Indexer(object):
         self.tags = [] # Prefixed fields
         self.aliases = {}
 
-    def _get_meta_values(self, obj):
-        if isinstance(obj, models.Model):
-            pk = obj.pk
+        if self.stemming_lang_accessor:
+            self._stemming_lang_field = self.field_class(self.stemming_lang_accessor)
         else:
-            pk = obj
-        return [pk, self._model_name, self.__class__.get_descriptor()]
+            self._stemming_lang_field = None
+
+        self._query_parsers = threading.local()
+
+    def _get_ids(self, database):
+        """
+        Returns registry ids of the model and the indexer in given writable
+        database or None if it uses legacy layout with full names
+        """
+        registry = Registry.load(database)
+
+        if not registry.filter_terms:
+            if not database.get_doccount():
+                # Every document added from now on gets filter terms
+                registry.enable_filter_terms(database)
+            elif self._db.get_paths() not in _without_filter_terms:
+                _without_filter_terms.add(self._db.get_paths())
+                logger.warning(
+                    "Index %s was built without filter terms, exact and in"
+                    " lookups are slower until it is rebuilt",
+                    ", ".join(self._db.get_paths())
+                )
+
+        if registry.legacy:
+            return None
+
+        return registry.pack(*registry.register(
+            database,
+            self._model_name,
+            self.__class__.get_descriptor()
+        ))
+
+    def _get_shard(self, database, obj, ids):
+        """
+        Returns writable database which stores given object (or object with
+        given pk) and registry ids for it. `ids` is a dict caching ids of
+        each database.
+        """
+        if isinstance(database, ShardedWriter):
+            database = database.get_shard(self._get_pk(obj))
+
+        try:
+            return database, ids[id(database)]
+        except KeyError:
+            ids[id(database)] = self._get_ids(database)
+            return database, ids[id(database)]
+
+    def _get_pk(self, obj):
+        if isinstance(obj, models.Model):
+            return obj.pk
+        return obj
 
-    def _insert_meta_values(self, doc, obj, start=1):
-        for value in self._get_meta_values(obj):
+    def _get_meta_values(self, obj, ids=None):
+        pk = self._get_pk(obj)
+
+        if ids is None:
+            return [pk, self._model_name, self.__class__.get_descriptor()]
+        return [pk, ids]
+
+    def _insert_meta_values(self, doc, obj, ids=None, start=1):
+        for value in self._get_meta_values(obj, ids):
             doc.add_value(start, smart_unicode(value))
             start += 1
         return start
 
-                
-    def _create_uid(self, obj):
+    def _create_uid(self, obj, ids=None):
         """
         Generates document UID for given object
         """
-        return "UID-" + "-".join(map(smart_unicode, self._get_meta_values(obj)))
+        return "UID-" + "-".join(map(smart_unicode, self._get_meta_values(obj, ids)))
 
+    def _delete(self, obj, database, ids):
+        database.delete_document(self._create_uid(obj, ids))
 
 
 
-    def _do_related(self, matches):
+
+    def _do_related(self, docids):
        """
        Fetches documents related to original set searched  for
        """
        database = self._db.open()
        enquire = xapian.Enquire(database)
        rdocs = xapian.RSet()
-       count = len(matches)
+       count = len(docids)
        if count < 10:
            count = 10
        if  count > 40:
            count = 40
-       for match in matches:
-           rdocs.add_document(match.get_docid())
+       for docid in docids:
+           rdocs.add_document(docid)
        terms = enquire.get_eset(count, rdocs)
        qterms = set([term.term for term in terms])
        query = []
@@ -376,19 +649,23 @@ class Indexer(object):
                        query.append(term)
                
        query = set(query)
-       print query
        return ' OR '.join(query)
                            
 
     def _do_search(self, query, offset, limit, order_by, flags, stemming_lang,
-                    filter, exclude):
+                    filter, exclude, check_at_least=0, timer=None):
         """
         flags are as defined in the Xapian API :
         http://www.xapian.org/docs/apidoc/html/classXapian_1_1QueryParser.html
         Combine multiple values with bitwise-or (|).
+        At least `check_at_least` documents are checked to make match
+        count estimate exact up to that number.
+        Phases are timed with `timer` (see `djapian.timing`) if given.
         """
         database = self._db.open()
         enquire = xapian.Enquire(database)
+        if timer is not None:
+            timer.lap("open")
 
         if order_by in (None, 'RELEVANCE'):
             enquire.set_sort_by_relevance()
@@ -400,27 +677,46 @@ class Indexer(object):
             if order_by[0] in '+-':
                 order_by = order_by[1:]
 
-            try:
-                valueno = self.tag_index(order_by)
-            except (ValueError, TypeError):
+            valueno = self.tag_index(order_by)
+            if valueno is None:
                 raise ValueError("Field %s cannot be used in order_by clause"
                                  " because it doen't exist in index" % order_by)
 
             enquire.set_sort_by_relevance_then_value(valueno, ascending)
 
         query, query_parser = self._parse_query(query, database, flags, stemming_lang)
-        enquire.set_query(
-            query
+        if timer is not None:
+            timer.lap("parse_query")
+
+        query, filter, exclude = decider.apply_filters(
+            query,
+            self._model,
+            self.tags,
+            filter,
+            exclude,
+            self._db.has_filter_terms()
         )
+        enquire.set_query(query)
 
-        decider = self.decider(self._model, self.tags, filter, exclude)
+        # Only lookups Xapian can't evaluate are left for the match decider
+        if filter or exclude:
+            match_decider = self.decider(self._model, self.tags, filter, exclude)
+        else:
+            match_decider = None
+        if timer is not None:
+            timer.lap("filters")
 
-        return enquire.get_mset(
+        mset = enquire.get_mset(
             offset,
             limit,
+            check_at_least,
             None,
-            decider
-        ), query, query_parser
+            match_decider
+        )
+        if timer is not None:
+            timer.lap("get_mset")
+
+        return mset, query, query_parser
       
   
 
@@ -433,10 +729,11 @@ class Indexer(object):
 
         if language == "multi":
             if obj:
-                try:
-                    language = self.field_class(self.stemming_lang_accessor).resolve(obj)
-                except AttributeError:
-                    pass
+                if self._stemming_lang_field is not None:
+                    try:
+                        language = self._stemming_lang_field.resolve(obj)
+                    except AttributeError:
+                        pass
             else:
                 language = "none"
 
@@ -446,6 +743,32 @@ class Indexer(object):
         """
         Parses search queries
         """
+        if stemming_lang in (None, "none"):
+            stemming_lang = self._get_stem_language()
+
+        query_parser = self._get_query_parser(stemming_lang)
+        query_parser.set_database(db)
+
+        parsed_query = query_parser.parse_query(term, flags)
+
+        return parsed_query, query_parser
+
+    def _get_query_parser(self, stemming_lang):
+        """
+        Returns query parser with registered prefixes and stemmer for given
+        language. Parsers are built once and kept per thread as they aren't
+        thread-safe.
+        """
+        try:
+            parsers = self._query_parsers.cache
+        except AttributeError:
+            parsers = self._query_parsers.cache = {}
+
+        try:
+            return parsers[stemming_lang]
+        except KeyError:
+            pass
+
         # Instance Xapian Query Parser
         query_parser = xapian.QueryParser()
 
@@ -455,19 +778,15 @@ class Indexer(object):
                 for alias in self.aliases[field.prefix]:
                     query_parser.add_prefix(alias, field.get_tag())
 
-        query_parser.set_database(db)
         query_parser.set_default_op(xapian.Query.OP_AND)
 
-        if stemming_lang in (None, "none"):
-            stemming_lang = self._get_stem_language()
-
         if stemming_lang:
-            query_parser.set_stemmer(xapian.Stem(stemming_lang))
+            query_parser.set_stemmer(utils.get_stemmer(stemming_lang))
             query_parser.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
 
-        parsed_query = query_parser.parse_query(term, flags)
+        parsers[stemming_lang] = query_parser
 
-        return parsed_query, query_parser
+        return query_parser
 
 class CompositeIndexer(Indexer):
     def __init__(self, *indexers):
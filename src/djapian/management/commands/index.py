@@ -1,44 +1,213 @@
-from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, connection
 from django.utils.daemonize import become_daemon
+from django.contrib.contenttypes.models import ContentType
 
 import os
 import sys
+import time
+import shutil
+import logging
 import operator
+import subprocess
+import tempfile
 from datetime import datetime
 from optparse import make_option
 
+import xapian
+
 from djapian.models import Change
 from djapian import utils
 from djapian import IndexSpace
+from djapian.database import retry_locked, ShardedWriter
+
+logger = logging.getLogger("djapian.index")
+
+def get_indexers(model):
+    return reduce(
+        operator.add,
+        [space.get_indexers_for_model(model) for space in IndexSpace.instances],
+        []
+    )
+
+def get_marker(indexer, operation):
+    """
+    Returns path of file which exists while index of `indexer` is rebuilt
+    (see `rebuild_index`) or compacted (see `compact`)
+    """
+    return "%s.%s" % (indexer._db._path, operation)
+
+def has_marker(indexers, operation):
+    for indexer in indexers:
+        if os.path.exists(get_marker(indexer, operation)):
+            return True
+    return False
+
+def create_marker(indexer, operation):
+    marker = get_marker(indexer, operation)
+
+    parent = os.path.dirname(marker)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    open(marker, "w").close()
+
+    return marker
+
+class ChangeBatch(object):
+    """
+    Collects changes for one indexer and pushes them into the index
+    through a single writer which is kept open for the whole drain cycle
+    """
+    def __init__(self, indexer, after_index, use_transaction, flush):
+        self.indexer = indexer
+        self.after_index = after_index
+        self.use_transaction = use_transaction
+        self.flush = flush
+
+        self.database = None
+        self.updates = []
+        self.deletes = []
+
+    def __len__(self):
+        return len(self.updates) + len(self.deletes)
+
+    def add(self, obj):
+        self.updates.append(obj)
+
+    def delete(self, pk):
+        self.deletes.append(pk)
+
+    def commit(self):
+        if not len(self):
+            return
+
+        if self.database is None:
+            self.database = retry_locked(
+                lambda: self.indexer._db.open(write=True)
+            )
+
+        for pk in self.deletes:
+            self.indexer.delete(pk, self.database)
+
+        if self.updates:
+            self.indexer.update(
+                self.updates,
+                self.after_index,
+                self.use_transaction,
+                self.flush,
+                database=self.database
+            )
+
+        self.database.flush()
+
+        self.updates = []
+        self.deletes = []
+
+    def close(self):
+        self.commit()
+        self.release()
+
+    def release(self):
+        # Release the write lock until the next cycle
+        if isinstance(self.database, ShardedWriter):
+            self.database.close()
+        self.database = None
 
 @transaction.commit_manually
-def update_changes(verbose, timeout, once, use_transaction, flush):
+def update_changes(verbose, timeout, once, use_transaction, flush, batch_size,
+                   compact_interval=0):
     def after_index(obj):
         if verbose:
             sys.stdout.write('.')
             sys.stdout.flush()
 
+    last_compact = time.time()
+
+    # Versions of changes applied while index of their model is rebuilt.
+    # The changes are kept for the rebuild to catch up with, but they are
+    # not applied again.
+    kept = {}
+
     while True:
-        changes = Change.objects.all().order_by("-date")# The objects must be sorted by date
-        objs_count = changes.count()
+        groups = {}
+        for pk, content_type, object_id, action, version in \
+                Change.objects.values_list("pk", "content_type", "object_id",
+                                           "action", "version").iterator():
+            groups.setdefault(content_type, []).append(
+                (pk, object_id, action, version)
+            )
+
+        objs_count = reduce(operator.add, map(len, groups.values()), 0)
 
         if objs_count > 0 and verbose:
             print 'There are %d objects to update' % objs_count
 
-        for change in changes:
-            indexers = reduce(
-                operator.add,
-                [space.get_indexers_for_model(change.content_type.model_class())
-                    for space in IndexSpace.instances]
-            )
+        batches = {}
 
-            for indexer in indexers:
-                if change.action == "delete":
-                    indexer.delete(change.object_id)
-                else:
-                    indexer.update([change.object], after_index, use_transaction, flush)
-            change.delete()
+        try:
+            for content_type, changes in groups.iteritems():
+                model = ContentType.objects.get_for_id(content_type).model_class()
+                indexers = get_indexers(model)
+
+                if has_marker(indexers, "compact"):
+                    # Changes wait in the queue until the compacted index
+                    # is swapped in
+                    continue
+
+                for indexer in indexers:
+                    if indexer not in batches:
+                        batches[indexer] = ChangeBatch(
+                            indexer,
+                            after_index,
+                            use_transaction,
+                            flush
+                        )
+
+                for start in range(0, len(changes), batch_size):
+                    chunk = changes[start:start + batch_size]
+                    pending = [change for change in chunk\
+                                    if kept.get(change[0]) != change[3]]
+
+                    deletes = [object_id for pk, object_id, action, version in pending\
+                                            if action == "delete"]
+                    updates = [model._meta.pk.to_python(object_id)\
+                                    for pk, object_id, action, version in pending\
+                                        if action != "delete"]
+
+                    if updates and indexers:
+                        instances = model._default_manager.in_bulk(updates)
+                        updates = [instances[pk] for pk in updates if pk in instances]
+
+                    for indexer in indexers:
+                        batch = batches[indexer]
+                        for pk in deletes:
+                            batch.delete(pk)
+                        for obj in updates:
+                            batch.add(obj)
+                        batch.commit()
+
+                    processed = [(pk, version) for pk, object_id, action, version in chunk]
+
+                    if has_marker(indexers, "rebuild"):
+                        kept.update(processed)
+                    else:
+                        # Changes updated since they were read are left for
+                        # the next cycle
+                        Change.objects.delete_processed(processed)
+
+                        for pk, version in processed:
+                            kept.pop(pk, None)
+
+            for batch in batches.values():
+                batch.close()
+        except xapian.DatabaseLockError:
+            # Another writer (e.g. compaction) holds the index for too long,
+            # changes which are not processed yet are left for the next cycle
+            if verbose:
+                print 'Index is locked, retrying in the next cycle'
+
+            for batch in batches.values():
+                batch.release()
 
         # Need to commit if using transactions (e.g. MySQL+InnoDB) since autocommit is
         # turned off by default according to PEP 249. See also:
@@ -48,22 +217,253 @@ def update_changes(verbose, timeout, once, use_transaction, flush):
         #                 implement this method with void functionality".
         transaction.commit()
 
+        if compact_interval and time.time() - last_compact >= compact_interval:
+            try:
+                compact(verbose)
+            except (xapian.Error, EnvironmentError,
+                    subprocess.CalledProcessError):
+                # E.g. another writer holds the index for too long
+                logger.exception("Index compaction failed, retrying in %d"
+                                 " seconds", compact_interval)
+            last_compact = time.time()
+
         if once:
             break
 
         time.sleep(timeout)
 
-def rebuild(verbose, transaction, flush):
+def rebuild(verbose, transaction, flush, chunk_size, workers=1):
     def after_index(obj):
         if verbose:
             sys.stdout.write('.')
             sys.stdout.flush()
 
+    for space_number, space in enumerate(IndexSpace.instances):
+        for model, indexers in space.get_indexers().iteritems():
+            for indexer_number in range(len(indexers)):
+                rebuild_index(
+                    (space_number, model, indexer_number),
+                    after_index,
+                    verbose,
+                    transaction,
+                    flush,
+                    chunk_size,
+                    workers
+                )
+
+def rebuild_index(address, after_index, verbose, transaction, flush, chunk_size,
+                  workers=1):
+    """
+    Rebuilds index of one indexer (see `get_indexer`)
+    """
+    indexer = get_indexer(address)
+
+    # The daemon keeps changes of the model in the queue while the marker
+    # exists, so ones made during the rebuild can be applied to the new index
+    marker = create_marker(indexer, "rebuild")
+
+    try:
+        # Index is built aside and swapped in when it is complete,
+        # so searches keep using the old one meanwhile
+        shadow = indexer._db.create_shadow()
+
+        try:
+            if workers > 1:
+                rebuild_parallel(address, shadow, verbose, transaction, flush,
+                                 chunk_size, workers)
+            else:
+                database = shadow.open(write=True)
+                indexer.update(None, after_index, transaction, flush,
+                               database=database, chunk_size=chunk_size)
+                database.flush()
+                del database
+
+            # The daemon can't write to the old index until it is swapped
+            writers = retry_locked(indexer._db._lock)
+
+            catch_up(indexer, shadow)
+        except:
+            shadow.clear()
+            raise
+
+        indexer._db.swap(shadow)
+
+        # Release the write lock
+        del writers
+    finally:
+        os.remove(marker)
+
+def catch_up(indexer, database):
+    """
+    Applies changes of the indexer's model which are in the queue to
+    `database`
+    """
+    # Queue should be read as it is now, not as the snapshot of the
+    # transaction rebuild has started in
+    transaction.commit_unless_managed()
+
+    model = indexer._model
+    changes = Change.objects.filter(
+        content_type=ContentType.objects.get_for_model(model)
+    ).values_list("object_id", "action")
+
+    deletes = []
+    updates = []
+    for object_id, action in changes:
+        if action == "delete":
+            deletes.append(object_id)
+        else:
+            updates.append(model._meta.pk.to_python(object_id))
+
+    writable = database.open(write=True)
+
+    for pk in deletes:
+        indexer.delete(pk, writable)
+
+    if updates:
+        indexer.update(model._default_manager.in_bulk(updates).values(),
+                       database=writable)
+
+    writable.flush()
+
+def compact(verbose):
     for space in IndexSpace.instances:
         for model, indexers in space.get_indexers().iteritems():
             for indexer in indexers:
-                indexer.clear()
-                indexer.update(None, after_index, transaction, flush)
+                size = indexer._db.get_size()
+                started = time.time()
+
+                # The daemon leaves changes of the model in the queue
+                # meanwhile instead of waiting for the lock
+                marker = create_marker(indexer, "compact")
+                try:
+                    indexer._db.compact()
+                finally:
+                    os.remove(marker)
+
+                if verbose:
+                    print "%s: %d -> %d bytes in %.2fs" % (
+                        indexer,
+                        size,
+                        indexer._db.get_size(),
+                        time.time() - started
+                    )
+
+def get_indexer(address):
+    space_number, model, indexer_number = address
+    return IndexSpace.instances[space_number].get_indexers()[model][indexer_number]
+
+def get_address(indexer):
+    """
+    Returns (space number, model, indexer number) triple identifying
+    `indexer` which can be passed between processes
+    """
+    for space_number, space in enumerate(IndexSpace.instances):
+        indexers = space.get_indexers_for_model(indexer._model)
+        if indexer in indexers:
+            return (space_number, indexer._model, indexers.index(indexer))
+    raise ValueError("Indexer %s is not registered" % indexer)
+
+def get_pk_ranges(model, count):
+    """
+    Splits primary keys of `model` into at most `count` ranges holding
+    about the same number of objects. Ranges are (lower, upper) pairs
+    where lower is inclusive, upper is exclusive and None means unbounded.
+    """
+    pk_name = model._meta.pk.name
+    pks = model._default_manager.order_by(pk_name).values_list(pk_name, flat=True)
+    total = pks.count()
+
+    bounds = [None]
+    for number in range(1, count):
+        offset = number * total // count
+        if offset == 0:
+            continue
+        bound = pks[offset]
+        if bound != bounds[-1]:
+            bounds.append(bound)
+    bounds.append(None)
+
+    return zip(bounds[:-1], bounds[1:])
+
+def rebuild_shard(address, lower, upper, path, verbose, transaction, flush,
+                  chunk_size):
+    """
+    Indexes objects with primary keys in [lower, upper) range into private
+    database (of the same layout as the indexer's one) at `path`
+    """
+    def after_index(obj):
+        if verbose:
+            sys.stdout.write('.')
+            sys.stdout.flush()
+
+    indexer = get_indexer(address)
+
+    queryset = indexer._model._default_manager.all()
+    if lower is not None:
+        queryset = queryset.filter(pk__gte=lower)
+    if upper is not None:
+        queryset = queryset.filter(pk__lt=upper)
+
+    # All shards of sharded layout must exist to be merged, even empty ones
+    db = indexer._db.with_path(path)
+    db.create_database()
+
+    database = db.open(write=True)
+    indexer.update(queryset, after_index, transaction, flush,
+                   database=database, chunk_size=chunk_size)
+    database.flush()
+
+    return path
+
+def _rebuild_shard(args):
+    # Connection inherited from parent process must not be shared
+    connection.close()
+
+    # Pool.map() passes a single argument
+    return rebuild_shard(*args)
+
+def rebuild_parallel(address, database, verbose, transaction, flush, chunk_size,
+                     workers, processes=True):
+    """
+    Builds index of one indexer into `database` using pool of `workers`
+    processes, each one builds a shard for its range of primary keys.
+    Shards are merged into `database` with xapian-compact.
+    Without `processes` shards are built one by one in current process.
+    """
+    import multiprocessing
+
+    indexer = get_indexer(address)
+    temp_dir = tempfile.mkdtemp(
+        prefix=".rebuild-",
+        dir=os.path.dirname(database._path)
+    )
+
+    try:
+        tasks = [
+            (address, lower, upper, os.path.join(temp_dir, "worker-%d" % number),
+             verbose, transaction, flush, chunk_size)
+            for number, (lower, upper) in enumerate(
+                get_pk_ranges(indexer._model, workers)
+            )
+        ]
+
+        if processes:
+            # Workers open their own connections after fork
+            connection.close()
+
+            pool = multiprocessing.Pool(min(workers, len(tasks)))
+            try:
+                shards = pool.map(_rebuild_shard, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            shards = [rebuild_shard(*task) for task in tasks]
+
+        database.merge(shards)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -84,6 +484,23 @@ class Command(BaseCommand):
         make_option("--flush", dest="flush", default=False,
                     action="store_true",
                     help="Flush changes on every document update"),
+        make_option("--batch-size", dest="batch_size", default=500, type="int",
+                    help="Number of changes to commit to the index at once"
+                         " (default: %default)"),
+        make_option("--chunk-size", dest="chunk_size", default=None, type="int",
+                    help="Number of objects to fetch from the database at once"
+                         " during rebuild (default: indexer's chunk_size)"),
+        make_option("--compact", dest="compact_index", default=False,
+                    action="store_true",
+                    help="Compact index databases"),
+        make_option("--compact-interval", dest="compact_interval", default=0,
+                    type="int",
+                    help="Seconds between index compactions done by the daemon,"
+                         " 0 disables them (default: %default)"),
+        make_option("--workers", dest="workers", default=1, type="int",
+                    help="Number of processes to rebuild index with, shards"
+                         " they build are merged with xapian-compact"
+                         " (default: %default)"),
     )
     help = "This is the Djapian daemon used to update the index based on djapian_change table."
 
@@ -91,16 +508,26 @@ class Command(BaseCommand):
 
     def handle(self, verbose=False, make_daemon=False, timeout=10,
                rebuild_index=False, transaction=False, flush=False,
-               *args, **options):
+               batch_size=500, chunk_size=None, workers=1, compact_index=False,
+               compact_interval=0, *args, **options):
         utils.load_indexes()
 
+        if not Change.objects.has_version():
+            raise CommandError(
+                "Table of changes was created by an older Djapian release,"
+                " upgrade it with:\n%s;" % Change.objects.get_upgrade_sql()
+            )
+
         if make_daemon:
             become_daemon()
 
-        if rebuild_index:
-            rebuild(verbose, transaction, flush)
+        if compact_index:
+            compact(verbose)
+        elif rebuild_index:
+            rebuild(verbose, transaction, flush, chunk_size, workers)
         else:
-            update_changes(verbose, timeout, not make_daemon, transaction, flush)
+            update_changes(verbose, timeout, not make_daemon, transaction, flush,
+                           batch_size, compact_interval)
 
         if verbose:
             print '\n'
@@ -0,0 +1,62 @@
+import sys
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--size", dest="size", default=1000, type="int",
+                    help="Number of entries in the corpus (default: %default)"),
+        make_option("--queries", dest="queries", default=100, type="int",
+                    help="Number of queries to measure each kind of search"
+                         " with (default: %default)"),
+        make_option("--workers", dest="workers", default=1, type="int",
+                    help="Number of processes to rebuild index with, more than"
+                         " one needs a file-backed test database with SQLite"
+                         " (default: %default)"),
+        make_option("--seed", dest="seed", default=0, type="int",
+                    help="Seed of the corpus generator (default: %default)"),
+        make_option("--output", dest="output", default=None,
+                    help="File to write JSON results to (default: stdout)"),
+        make_option("--label", dest="label", default=None,
+                    help="Label stored with results, e.g. revision"),
+    )
+    help = "Measures indexing and search performance on a synthetic corpus."
+
+    requires_model_validation = True
+
+    def handle(self, size=1000, queries=100, workers=1, seed=0, output=None,
+               label=None, *args, **options):
+        from djapian import benchmark
+
+        if workers > 1 and settings.DATABASE_ENGINE == "sqlite3" and \
+                getattr(settings, "TEST_DATABASE_NAME", None) in (None, "", ":memory:"):
+            # Worker processes open their own connections and would not see
+            # an in-memory database
+            raise CommandError(
+                "--workers greater than 1 requires a file-backed test database,"
+                " set TEST_DATABASE_NAME to a file path"
+            )
+
+        # Corpus is created in a scratch test database
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = benchmark.run(size, queries, workers, seed)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results["label"] = label
+
+        if output is None:
+            simplejson.dump(results, sys.stdout, indent=2)
+            print
+        else:
+            stream = open(output, "w")
+            try:
+                simplejson.dump(results, stream, indent=2)
+            finally:
+                stream.close()
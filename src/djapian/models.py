@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, connection, transaction
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.utils.encoding import smart_str
@@ -7,11 +8,122 @@ from datetime import datetime
 
 from djapian import utils
 
+# Coalescing upsert statements keyed by backend. The existing "add" change
+# absorbs any later "add" or "edit", otherwise the new action wins. Version
+# is bumped so the change is not removed if it was read before the update.
+UPSERT_SQL = {
+    "sqlite3": "INSERT INTO %(table)s (%(content_type)s, %(object_id)s, %(date)s,"
+               " %(action)s, %(version)s)"
+               " VALUES %(values)s"
+               " ON CONFLICT (%(content_type)s, %(object_id)s) DO UPDATE SET"
+               " %(action)s = CASE WHEN %(table)s.%(action)s = 'add' THEN 'add'"
+               " ELSE excluded.%(action)s END,"
+               " %(date)s = excluded.%(date)s,"
+               " %(version)s = %(table)s.%(version)s + 1",
+    "mysql": "INSERT INTO %(table)s (%(content_type)s, %(object_id)s, %(date)s,"
+             " %(action)s, %(version)s)"
+             " VALUES %(values)s"
+             " ON DUPLICATE KEY UPDATE"
+             " %(action)s = IF(%(action)s = 'add', 'add', VALUES(%(action)s)),"
+             " %(date)s = VALUES(%(date)s),"
+             " %(version)s = %(version)s + 1",
+}
+UPSERT_SQL["postgresql"] = UPSERT_SQL["postgresql_psycopg2"] = UPSERT_SQL["sqlite3"]
+
+# Upgrades change table created before `Change.version` was added
+UPGRADE_SQL = "ALTER TABLE %(table)s ADD COLUMN %(version)s integer NOT NULL DEFAULT 0"
+
 class ChangeManager(models.Manager):
+    # Rows per INSERT or DELETE statement
+    chunk_size = 500
+
     def create(self, object, action, **kwargs):
-        ct = ContentType.objects.get_for_model(object.__class__)
-        pk = smart_str(object.pk)
+        self.enqueue(object, action)
+
+        try:
+            return self.get(
+                content_type=ContentType.objects.get_for_model(object.__class__),
+                object_id=smart_str(object.pk)
+            )
+        except self.model.DoesNotExist:
+            return None
+
+    def enqueue(self, object, action):
+        """
+        Registers change of given object merging it with the pending one
+        """
+        self.enqueue_many(object.__class__, [object.pk], action)
+
+    def enqueue_many(self, model, pks, action):
+        """
+        Registers the same change for many objects of given model at once,
+        e.g. after `QuerySet.update()` or `QuerySet.delete()`
+        """
+        ct = ContentType.objects.get_for_model(model)
+        pks = [smart_str(pk) for pk in pks]
+
+        sql = self._get_upsert_sql()
+        if sql is None:
+            for pk in pks:
+                self._enqueue_one(ct, pk, action)
+            return
+
+        now = connection.ops.value_to_db_datetime(datetime.now())
+        cursor = connection.cursor()
+
+        for start in range(0, len(pks), self.chunk_size):
+            chunk = pks[start:start + self.chunk_size]
+
+            if action == "delete":
+                # Objects which were not indexed yet just leave the queue
+                added = self._delete_added(cursor, ct, chunk)
+                chunk = [pk for pk in chunk if pk not in added]
+
+                if not chunk:
+                    continue
+
+            params = []
+            for pk in chunk:
+                params.extend([ct.pk, pk, now, action])
+
+            cursor.execute(
+                sql % self._get_columns(
+                    values=", ".join(["(%s, %s, %s, %s, 0)"] * len(chunk))
+                ),
+                params
+            )
+        transaction.commit_unless_managed()
+
+    def _delete_added(self, cursor, ct, pks):
+        """
+        Removes pending "add" changes for given object ids and returns ids
+        of removed changes
+        """
+        if len(pks) == 1:
+            added = pks
+        else:
+            added = set(self.filter(
+                content_type=ct,
+                object_id__in=pks,
+                action="add"
+            ).values_list("object_id", flat=True))
 
+            if not added:
+                return added
+
+        cursor.execute(
+            "DELETE FROM %(table)s WHERE %(content_type)s = %%s"
+            " AND %(object_id)s IN (%(values)s) AND %(action)s = 'add'" % \
+                self._get_columns(values=", ".join(["%s"] * len(added))),
+            [ct.pk] + list(added)
+        )
+
+        if len(pks) == 1 and not cursor.rowcount:
+            return set()
+
+        return set(added)
+
+    def _enqueue_one(self, ct, pk, action):
         try:
             old_change = self.get(
                 content_type=ct,
@@ -20,10 +132,10 @@ class ChangeManager(models.Manager):
             if old_change.action=="add":
                 if action=="edit":
                     old_change.save()
-                    return old_change
+                    return
                 elif action=="delete":
                     old_change.delete()
-                    return None
+                    return
             old_change.delete()
         except self.model.DoesNotExist:
             old_change = self.model(content_type=ct, object_id=pk)
@@ -31,7 +143,82 @@ class ChangeManager(models.Manager):
         old_change.action = action
         old_change.save()
 
-        return old_change
+    def _get_upsert_sql(self):
+        engine = settings.DATABASE_ENGINE
+
+        if engine == "sqlite3":
+            # ON CONFLICT clause requires SQLite 3.24
+            try:
+                from sqlite3 import sqlite_version_info
+            except ImportError:
+                from pysqlite2.dbapi2 import sqlite_version_info
+
+            if sqlite_version_info < (3, 24, 0):
+                return None
+        elif engine in ("postgresql", "postgresql_psycopg2"):
+            # ON CONFLICT clause requires PostgreSQL 9.5
+            if connection.ops.postgres_version[:2] < (9, 5):
+                return None
+
+        return UPSERT_SQL.get(engine)
+
+    def has_version(self):
+        """
+        Checks if the change table has version column, tables created by
+        older releases need to be upgraded with `get_upgrade_sql()`
+        """
+        cursor = connection.cursor()
+        columns = [
+            row[0] for row in connection.introspection.get_table_description(
+                cursor,
+                self.model._meta.db_table
+            )
+        ]
+
+        return self.model._meta.get_field("version").column in columns
+
+    def get_upgrade_sql(self):
+        return UPGRADE_SQL % self._get_columns()
+
+    def _get_columns(self, **kwargs):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+
+        columns = {
+            "table": qn(opts.db_table),
+            "pk": qn(opts.pk.column),
+        }
+        for name in ("content_type", "object_id", "date", "action", "version"):
+            columns[name] = qn(opts.get_field(name).column)
+        columns.update(kwargs)
+
+        return columns
+
+    def delete_processed(self, changes):
+        """
+        Removes processed changes given as (pk, version) pairs with as few
+        statements as possible. Changes which were updated after they were
+        read have another version and are kept to be processed again.
+        """
+        versions = {}
+        for pk, version in changes:
+            versions.setdefault(version, []).append(pk)
+
+        cursor = connection.cursor()
+
+        for version, pks in versions.iteritems():
+            # Keep number of query parameters under backends' limits
+            for start in range(0, len(pks), self.chunk_size):
+                chunk = pks[start:start + self.chunk_size]
+
+                cursor.execute(
+                    "DELETE FROM %(table)s WHERE %(pk)s IN (%(values)s)"
+                    " AND %(version)s = %%s" % self._get_columns(
+                        values=", ".join(["%s"] * len(chunk))
+                    ),
+                    chunk + [version]
+                )
+        transaction.commit_unless_managed()
 
 
 class Change(models.Model):
@@ -46,6 +233,9 @@ class Change(models.Model):
 
     date = models.DateTimeField(default=datetime.now)
     action = models.CharField(max_length=6, choices=ACTIONS)
+    # Bumped on each update, unlike `date` it is never equal for two
+    # updates (e.g. MySQL drops microseconds)
+    version = models.PositiveIntegerField(default=0)
 
     object = generic.GenericForeignKey()
 
@@ -61,6 +251,7 @@ class Change(models.Model):
 
     def save(self):
         self.date = datetime.now()
+        self.version += 1
 
         super(Change, self).save()
 
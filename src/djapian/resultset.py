@@ -1,10 +1,12 @@
 import xapian
 import operator
+import warnings
 from copy import deepcopy
 
 from django.db.models import get_model
 
-from djapian import utils, decider
+from djapian import utils, decider, timing, executor
+from djapian.database import pool
 
 class defaultdict(dict):
     def __init__(self, value_type):
@@ -15,18 +17,99 @@ class defaultdict(dict):
             dict.__setitem__(self, key, list())
         return dict.__getitem__(self, key)
 
+_models = {}
+
+def get_model_by_name(name):
+    """
+    Returns model class for stored "app_label.ModelName" string
+    """
+    try:
+        return _models[name]
+    except KeyError:
+        model = get_model(*name.split('.'))
+        if model is not None:
+            _models[name] = model
+        return model
+
+def search_many(searches, threaded=False):
+    """
+    Runs `searches` against one snapshot of the index, so their results
+    are consistent with each other. Items of `searches` are result sets,
+    which are fetched, or their bound methods like `result_set.count`,
+    which are called. Returns list of results in the same order.
+    With `threaded` set searches run in parallel in pool threads (see
+    `djapian.executor`), ones which happen to see other revision of the
+    index are repeated in current thread.
+    """
+    pool.freeze()
+    try:
+        revisions = {}
+        for search in searches:
+            db = _get_search_db(search)
+            if db not in revisions:
+                revisions[db] = db.get_revision()
+
+        if not threaded:
+            return [_run_search(search) for search in searches]
+
+        futures = [
+            executor.get_executor().submit(_run_search, search, revisions)
+            for search in searches
+        ]
+
+        results = []
+        for search, future in zip(searches, futures):
+            result = future.result()
+            if result is _stale:
+                result = _run_search(search)
+            results.append(result)
+
+        return results
+    finally:
+        pool.thaw()
+
+# Marks result of search which saw another revision of the index
+_stale = object()
+
+def _get_search_db(search):
+    return getattr(search, "im_self", search)._indexer._db
+
+def _run_search(search, revisions=None):
+    if revisions is not None:
+        pool.freeze()
+    try:
+        if revisions is not None:
+            db = _get_search_db(search)
+            if db.get_revision() != revisions[db]:
+                return _stale
+
+        if isinstance(search, ResultSet):
+            return search._fetch_results()
+        return search()
+    finally:
+        if revisions is not None:
+            pool.thaw()
+
 class ResultSet(object):
+    # Number of matches fetched from Xapian at once during iteration
+    window_size = utils.DEFAULT_WINDOW_SIZE
+
     def __init__(self, indexer, query_str, offset=0, limit=utils.DEFAULT_MAX_RESULTS,
                  order_by=None, prefetch=False, flags=None, stemming_lang=None,
-                 filter=None, exclude=None, prefetch_select_related=False):
+                 filter=None, exclude=None, prefetch_select_related=False,
+                 prefetch_options=None, instance_cache=None):
         self._indexer = indexer
         self._query_str = query_str
-        print self._query_str
         self._offset = offset
         self._limit = limit
         self._order_by = order_by
         self._prefetch = prefetch
         self._prefetch_select_related = prefetch_select_related
+        self._prefetch_options = prefetch_options or {}
+        # Prefetched instances shared by pages (slices) of this set
+        if instance_cache is None:
+            instance_cache = {}
+        self._instance_cache = instance_cache
         self._filter = filter or decider.X()
         self._exclude = exclude or decider.X()
 
@@ -38,9 +121,10 @@ class ResultSet(object):
         self._stemming_lang = stemming_lang
 
         self._resultset_cache = None
-        self._mset = None
+        self._windows = {}
         self._query = None
         self._query_parser = None
+        self._corrected_query_string = None
 
     # Public methods that produce another ResultSet
 
@@ -53,10 +137,27 @@ class ResultSet(object):
                                 | xapian.QueryParser.FLAG_WILDCARD
         )
 
-    def prefetch(self, select_related=False):
+    def prefetch(self, select_related=False, only=None, defer=None,
+                 prefetch_related=None, querysets=None):
+        """
+        Makes hits fetch their instances with one query per model.
+        `select_related` is either boolean or list of relations. `only`,
+        `defer` and `prefetch_related` are lists of field names applied to
+        instances of every model or dicts of such lists by model.
+        `querysets` maps models to querysets to fetch instances from (other
+        options are applied on top of them) or callables which take the
+        queryset with options applied and return a new one.
+        """
         return self._clone(
             prefetch=True,
-            prefetch_select_related=select_related
+            prefetch_select_related=select_related,
+            prefetch_options={
+                "only": only,
+                "defer": defer,
+                "prefetch_related": prefetch_related,
+                "querysets": querysets,
+            },
+            instance_cache={}
         )
 
     def order_by(self, field):
@@ -68,12 +169,31 @@ class ResultSet(object):
     def stemming(self, lang):
         return self._clone(stemming_lang=lang)
 
-    def count(self):
-        return self._clone()._do_count()
+    def count(self, exact=False):
+        """
+        Returns number of matches. Unless `exact` is set it is an estimate
+        which is exact for up to `utils.DEFAULT_CHECK_AT_LEAST` matches.
+        """
+        return self._do_count(exact)
+
+    def exists(self):
+        """
+        Checks if there is at least one match
+        """
+        if self._limit <= 0:
+            return False
+
+        timer = self._get_timer("exists")
+        exists = self._get_mset(self._offset, 1, timer=timer).size() > 0
+        if timer is not None:
+            timer.finish()
+
+        return exists
 
     def get_corrected_query_string(self):
-        self._get_mset()
-        return self._query_parser.get_corrected_query_string()
+        if self._corrected_query_string is None:
+            self._get_mset(self._offset, 0)
+        return self._corrected_query_string
 
     def filter(self, *fields, **raw_fields):
         clone = self._clone()
@@ -126,6 +246,8 @@ class ResultSet(object):
             "order_by": self._order_by,
             "prefetch": self._prefetch,
             "prefetch_select_related": self._prefetch_select_related,
+            "prefetch_options": self._prefetch_options,
+            "instance_cache": self._instance_cache,
             "flags": self._flags,
             "stemming_lang": self._stemming_lang,
             "filter": deepcopy(self._filter),
@@ -133,82 +255,278 @@ class ResultSet(object):
         }
         data.update(kwargs)
 
-        return ResultSet(**data)
+        return self._get_clone_class()(**data)
 
-    def _do_count(self):
-        self._get_mset()
+    def _get_clone_class(self):
+        return self.__class__
 
-        return self._mset.size()
+    def _do_count(self, exact=False):
+        if self._resultset_cache is not None:
+            return len(self._resultset_cache)
+
+        if exact:
+            check_at_least = self._indexer.document_count()
+        else:
+            check_at_least = utils.DEFAULT_CHECK_AT_LEAST
+
+        timer = self._get_timer("count")
+        mset = self._get_mset(self._offset, 0, check_at_least, timer)
+        if timer is not None:
+            timer.finish()
 
-    def _do_prefetch(self):
+        count = mset.get_matches_estimated() - self._offset
+
+        return max(0, min(count, self._limit))
+
+    def _do_prefetch(self, hits):
         model_map = defaultdict(list)
 
-        for hit in self._resultset_cache:
+        for hit in hits:
             model_map[hit.model].append(hit)
 
         for model, hits in model_map.iteritems():
-            pks = [hit.pk for hit in hits]
+            instances = self._instance_cache.setdefault(model, {})
+
+            pks = [hit.pk for hit in hits if hit.pk not in instances]
+            if pks:
+                instances.update(self._get_prefetch_queryset(model).in_bulk(pks))
+
+            for hit in hits:
+                if hit.pk in instances:
+                    hit.instance = instances[hit.pk]
 
+    def _get_prefetch_queryset(self, model):
+        options = self._prefetch_options
+
+        queryset = (options.get("querysets") or {}).get(model)
+        if queryset is None or callable(queryset):
             instances = model._default_manager.all()
+        else:
+            # Given queryset is the base for the rest of options
+            instances = queryset.all()
 
-            if self._prefetch_select_related:
+        if self._prefetch_select_related:
+            if isinstance(self._prefetch_select_related, (list, tuple)):
+                instances = instances.select_related(*self._prefetch_select_related)
+            else:
                 instances = instances.select_related()
 
-            instances = instances.in_bulk(pks)
+        for name in ("only", "defer", "prefetch_related"):
+            fields = options.get(name)
+            if isinstance(fields, dict):
+                fields = fields.get(model)
+
+            if fields:
+                instances = getattr(instances, name)(*fields)
+
+        if callable(queryset):
+            instances = queryset(instances)
+
+        return instances
+
+    def _get_timer(self, operation):
+        return timing.get_timer(
+            operation,
+            indexer=self._indexer,
+            query=self._query_str,
+            filter=self._filter,
+            exclude=self._exclude,
+            order_by=self._order_by,
+            offset=self._offset,
+            limit=self._limit
+        )
 
-            for hit in hits:
-                hit.instance = instances[hit.pk]
-
-    def _get_mset(self):
-        if self._mset is None:
-            self._mset, self._query, self._query_parser = self._indexer._do_search(
-                self._query_str,
-                self._offset,
-                self._limit,
-                self._order_by,
-                self._flags,
-                self._stemming_lang,
-                self._filter,
-                self._exclude,
+    def _get_mset(self, offset, limit, check_at_least=0, timer=None):
+        cache = self._indexer.result_cache
+
+        if cache is not None:
+            key = self._get_cache_key(offset, limit, check_at_least)
+
+            mset = cache.get(key)
+            if timer is not None:
+                timer.lap("cache")
+            if mset is not None:
+                self._corrected_query_string = mset.corrected_query_string
+                return mset
+
+        mset, self._query, self._query_parser = self._indexer._do_search(
+            self._query_str,
+            offset,
+            limit,
+            self._order_by,
+            self._flags,
+            self._stemming_lang,
+            self._filter,
+            self._exclude,
+            check_at_least,
+            timer,
+        )
+        # Query parsers are shared, so take the correction before
+        # the parser is used by another search
+        if cache is not None:
+            mset = MatchSet(
+                mset,
+                [1, 2] + [tag.number for tag in self._indexer.tags],
+                self._query_parser.get_corrected_query_string()
             )
+        else:
+            mset = LiveMatchSet(
+                mset,
+                self._query_parser.get_corrected_query_string()
+            )
+        self._corrected_query_string = mset.corrected_query_string
+        if timer is not None:
+            timer.lap("read_matches")
+
+        if cache is not None:
+            cache.set(key, mset)
+
+        return mset
+
+    def _get_cache_key(self, offset, limit, check_at_least):
+        # Revision starts over in the directory swapped in by rebuild or
+        # compaction, so the key uses directories instead of configured paths
+        return (
+            self._indexer._db.get_locations(),
+            self._indexer._db.get_revision(),
+            self._query_str,
+            offset,
+            limit,
+            check_at_least,
+            self._order_by,
+            self._flags,
+            self._stemming_lang,
+            str(self._filter),
+            str(self._exclude),
+        )
+
+    def _get_window(self, index):
+        """
+        Returns hits of window with given number fetching it if needed
+        """
+        try:
+            return self._windows[index]
+        except KeyError:
+            start = index * self.window_size
+            size = min(self.window_size, self._limit - start)
+
+            if size > 0:
+                timer = self._get_timer("search")
+                hits = self._parse_results(
+                    self._get_mset(self._offset + start, size, timer=timer),
+                    timer
+                )
+                if timer is not None:
+                    timer.finish()
+            else:
+                hits = []
+
+            self._windows[index] = hits
+            return hits
+
+    def _is_last_window(self, index, hits):
+        return len(hits) < self.window_size\
+                    or (index + 1) * self.window_size >= self._limit
+
+    def _iter_windows(self):
+        index = 0
+
+        while True:
+            hits = self._get_window(index)
+
+            for hit in hits:
+                yield hit
+
+            if self._is_last_window(index, hits):
+                break
+
+            index += 1
 
     def _fetch_results(self):
         if self._resultset_cache is None:
-            self._get_mset()
-            self._parse_results()
+            results = []
+
+            # Reuse already fetched windows and get the rest in one search
+            index = 0
+            while index in self._windows:
+                hits = self._windows[index]
+                results.extend(hits)
+
+                if self._is_last_window(index, hits):
+                    break
+
+                index += 1
+            else:
+                start = len(results)
+                if start < self._limit:
+                    timer = self._get_timer("search")
+                    results.extend(self._parse_results(
+                        self._get_mset(
+                            self._offset + start,
+                            self._limit - start,
+                            timer=timer
+                        ),
+                        timer
+                    ))
+                    if timer is not None:
+                        timer.finish()
+
+            self._resultset_cache = results
 
         return self._resultset_cache
 
-    def _parse_results(self):
-        self._resultset_cache = []
+    def _parse_results(self, mset, timer=None):
+        hits = []
 
-        for match in self._mset:
-            doc = match.get_document()
+        tags = self._indexer.tags
 
-            model = doc.get_value(2)
-            model = get_model(*model.split('.'))
-            pk = model._meta.pk.to_python(doc.get_value(1))
+        for match in mset:
+            values = match.values
 
-            percent = match.get_percent()
-            rank = match.get_rank()
-            weight = match.get_weight()
+            model = self._get_model(match.docid, values[2])
+            pk = model._meta.pk.to_python(values[1])
 
-            tags = dict([(tag.prefix, tag.extract(doc))\
-                                for tag in self._indexer.tags])
-            self._resultset_cache.append(
-                Hit(pk, model, match,  percent, rank, weight, tags)
+            hits.append(
+                Hit(pk, model, match.docid, match.percent, match.rank,
+                    match.weight, values, tags)
             )
 
+        if timer is not None:
+            timer.lap("parse_results")
+
         if self._prefetch:
-            self._do_prefetch()
+            self._do_prefetch(hits)
+
+            if timer is not None:
+                timer.lap("prefetch")
+
+        return hits
+
+    def _get_model(self, docid, value):
+        """
+        Returns model of document from its packed ids value
+        """
+        if '.' in value:
+            # Legacy layout with full model name
+            return get_model_by_name(value)
+
+        db = self._indexer._db
+        registry = db.get_registry(docid)
+        model_id = registry.unpack(value)[0]
+
+        if model_id >= len(registry.models):
+            # Model was registered after registry had been loaded
+            registry = db.get_registry(docid, refresh=True)
+
+        return get_model_by_name(registry.models[model_id])
 
     def __iter__(self):
-        self._fetch_results()
-        return iter(self._resultset_cache)
+        if self._resultset_cache is not None:
+            return iter(self._resultset_cache)
+        return self._iter_windows()
 
     def __len__(self):
-        self._fetch_results()
-        return len(self._resultset_cache)
+        return len(self._fetch_results())
 
     def __getitem__(self, k):
         if not isinstance(k, (slice, int, long)):
@@ -219,50 +537,188 @@ class ResultSet(object):
                 "Negative indexing is not supported."
 
         if self._resultset_cache is not None:
-            return self._fetch_results()[k]
+            return self._resultset_cache[k]
         else:
             if isinstance(k, slice):
                 start, stop = k.start, k.stop
                 if start is None:
                     start = 0
-                if stop is None:
-                    kstop = utils.DEFAULT_MAX_RESULTS
+                if stop is None or stop > self._limit:
+                    stop = self._limit
 
                 return self._clone(
-                    offset=start,
-                    limit=stop - start
+                    offset=self._offset + start,
+                    limit=max(0, stop - start)
                 )
             else:
-                return list(self._clone(
-                    offset=k,
-                    limit=1
-                ))[k]
+                if k >= self._limit:
+                    raise IndexError("ResultSet index out of range")
+
+                hits = self._get_window(k // self.window_size)
+                try:
+                    return hits[k % self.window_size]
+                except IndexError:
+                    raise IndexError("ResultSet index out of range")
+
+    def __unicode__(self):
+        return "<ResultSet: query=%s prefetch=%s>" % (self._query_str, self._prefetch)
+
+class MatchSet(object):
+    """
+    Plain copy of Xapian MSet with given document values which can be
+    cached and pickled
+    """
+    def __init__(self, mset, valuenos, corrected_query_string=""):
+        self.matches_estimated = mset.get_matches_estimated()
+        self.corrected_query_string = corrected_query_string
+        self.matches = []
+
+        for item in mset:
+            doc = item.get_document()
+
+            self.matches.append(Match(
+                item.get_docid(),
+                item.get_percent(),
+                item.get_rank(),
+                item.get_weight(),
+                dict([(valueno, doc.get_value(valueno)) for valueno in valuenos])
+            ))
+
+    def get_matches_estimated(self):
+        return self.matches_estimated
+
+    def size(self):
+        return len(self.matches)
+
+    def __iter__(self):
+        return iter(self.matches)
+
+class LiveMatchSet(object):
+    """
+    Xapian MSet which is used right away (as results aren't cached),
+    document values are read only when they are accessed
+    """
+    def __init__(self, mset, corrected_query_string=""):
+        self.corrected_query_string = corrected_query_string
+        self._mset = mset
+
+    def get_matches_estimated(self):
+        return self._mset.get_matches_estimated()
+
+    def size(self):
+        return self._mset.size()
+
+    def __iter__(self):
+        for item in self._mset:
+            yield Match(
+                item.get_docid(),
+                item.get_percent(),
+                item.get_rank(),
+                item.get_weight(),
+                DocumentValues(item.get_document())
+            )
+
+class DocumentValues(object):
+    """
+    Values of Xapian document by value numbers
+    """
+    __slots__ = ('_document',)
+
+    def __init__(self, document):
+        self._document = document
+
+    def __getitem__(self, valueno):
+        return self._document.get_value(valueno)
+
+class Match(object):
+    def __init__(self, docid, percent, rank, weight, values):
+        self.docid = docid
+        self.percent = percent
+        self.rank = rank
+        self.weight = weight
+        self.values = values
+
+    def get_docid(self):
+        return self.docid
+
+    def get_percent(self):
+        return self.percent
+
+    def get_rank(self):
+        return self.rank
+
+    def get_weight(self):
+        return self.weight
+
+class AsyncResultSet(ResultSet):
+    """
+    Result set whose results are fetched in a pool thread (see
+    `djapian.executor`) so the caller isn't blocked by Xapian match and
+    instances prefetch
+    """
+    def fetch(self, offset=0, limit=None):
+        """
+        Returns future of list of hits in given slice of results
+        """
+        if limit is None:
+            clone = self[offset:]
+        else:
+            clone = self[offset:offset + limit]
 
-        def __unicode__(self):
-            return "<ResultSet: query=%s prefetch=%s>" % (self.query_str, self._prefetch)
+        if isinstance(clone, list):
+            # Results are fetched already
+            future = executor.Future()
+            future._finish(clone)
+            return future
+
+        return executor.get_executor().submit(clone._fetch_results)
+
+    def fetch_count(self, exact=False):
+        """
+        Returns future of number of matches (see `ResultSet.count`)
+        """
+        return executor.get_executor().submit(self.count, exact)
 
 class ResultRelatedSet(ResultSet):
     def __init__(self, indexer, hits, offset=0, limit=utils.DEFAULT_MAX_RESULTS,
                  order_by=None, prefetch=False, flags=None, stemming_lang=None,
-                 filter=None, exclude=None, prefetch_select_related=False):
-        matches = [ hit.msetitem for hit in hits]
-        query = indexer._do_related(matches)
+                 filter=None, exclude=None, prefetch_select_related=False,
+                 prefetch_options=None, instance_cache=None):
+        query = indexer._do_related([hit.docid for hit in hits])
         ResultSet.__init__(self, indexer, query, offset, limit,
                  order_by, prefetch, flags, stemming_lang,
-                 filter, exclude, prefetch_select_related)
-        print self.count()
+                 filter, exclude, prefetch_select_related,
+                 prefetch_options, instance_cache)
+
+    def _get_clone_class(self):
+        # Clones keep the query built from hits instead of the hits
+        return ResultSet
 
 class Hit(object):
-    def __init__(self, pk, model, msetitem, percent, rank, weight, tags):
+    __slots__ = ('pk', 'model', 'docid', 'percent', 'rank', 'weight',
+                 '_values', '_fields', '_tags', '_instance')
+
+    def __init__(self, pk, model, docid, percent, rank, weight, values, fields):
         self.pk = pk
         self.model = model
-        self.msetitem = msetitem
+        self.docid = docid
         self.percent = percent
         self.rank = rank
         self.weight = weight
-        self.tags = tags
+        self._values = values
+        self._fields = fields
+        self._tags = None
         self._instance = None
 
+    def get_tags(self):
+        # Tag values are decoded on first access only
+        if self._tags is None:
+            self._tags = dict([(tag.prefix, tag.decode(self._values[tag.number]))\
+                                    for tag in self._fields])
+        return self._tags
+
+    tags = property(get_tags)
+
     def get_instance(self):
         if self._instance is None:
             self._instance = self.model._default_manager.get(pk=self.pk)
@@ -273,6 +729,22 @@ class Hit(object):
 
     instance = property(get_instance, set_instance)
 
+    def get_msetitem(self):
+        """
+        Deprecated: hits don't keep Xapian match items anymore. Returns
+        `Match` with the same getters (except `get_document()`).
+        """
+        warnings.warn(
+            "Hit.msetitem is deprecated, use Hit.docid, percent, rank and"
+            " weight attributes",
+            DeprecationWarning,
+            stacklevel=2
+        )
+        return Match(self.docid, self.percent, self.rank, self.weight,
+                     self._values)
+
+    msetitem = property(get_msetitem)
+
     def __repr__(self):
         return "<Hit: model=%s pk=%s, percent=%s rank=%s weight=%s>" % (
             utils.model_name(self.model), self.pk, self.percent, self.rank, self.weight
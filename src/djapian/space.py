@@ -6,16 +6,17 @@ from django.conf import settings
 from django.utils.datastructures import SortedDict
 
 from djapian import utils
-from djapian.database import Database
+from djapian.database import Database, ShardedDatabase
 from djapian.indexer import Indexer
 
 class IndexSpace(object):
     instances = []
 
-    def __init__(self, base_dir, name):
+    def __init__(self, base_dir, name, shards=1):
         self._base_dir = os.path.abspath(base_dir)
         self._indexers = SortedDict()
         self._name = name
+        self._shards = shards
 
         self.__class__.instances.append(self)
 
@@ -26,19 +27,29 @@ class IndexSpace(object):
         from django.utils.encoding import smart_str
         return smart_str(self.__unicode__())
 
-    def add_index(self, model, indexer=None, attach_as=None):
+    def add_index(self, model, indexer=None, attach_as=None, shards=None):
+        """
+        Registers index for `model`. Index is split into `shards` databases
+        if given (or if set in `indexer.shards` or for the whole space).
+        """
         if indexer is None:
             indexer = self.create_default_indexer(model)
 
-        db = Database(
-            os.path.join(
-                self._base_dir,
-                model._meta.app_label,
-                model._meta.object_name.lower(),
-                indexer.get_descriptor()
-            )
+        if shards is None:
+            shards = indexer.shards or self._shards
+
+        path = os.path.join(
+            self._base_dir,
+            model._meta.app_label,
+            model._meta.object_name.lower(),
+            indexer.get_descriptor()
         )
 
+        if shards > 1:
+            db = ShardedDatabase(path, shards)
+        else:
+            db = Database(path)
+
         indexer = indexer(db, model)
 
         if attach_as is not None:
@@ -1,4 +1,7 @@
 import os
+from datetime import datetime
+
+import xapian
 
 from djapian import Field
 from djapian.tests.utils import BaseTestCase, BaseIndexerTest, Entry, Person
@@ -32,6 +35,46 @@ class FieldResolverTest(BaseTestCase):
             "Alex - Test entry"
         )
 
+class FieldConverterTest(BaseTestCase):
+    def test_model_field(self):
+        field = Field("asset_count")
+        field.compile(Entry)
+
+        self.assertEqual(field.convert(5, Entry), "000000000005")
+
+    def test_value_type(self):
+        field = Field("headline")
+        field.compile(Entry)
+
+        # bool is a subclass of int, so such values match the integer
+        # converter first (as they always did, indexes rely on it)
+        self.assertEqual(field.convert(True, Entry), "000000000001")
+        self.assertEqual(field.convert(1.5, Entry), "1.5000000000")
+        self.assertEqual(field.convert(5, Entry), "000000000005")
+
+    def test_sortable(self):
+        field = Field("asset_count", number=11)
+        field.compile(Entry, "sortable")
+
+        self.assert_(field.convert(-5, Entry) < field.convert(3, Entry))
+        self.assert_(field.convert(3, Entry) < field.convert(20, Entry))
+
+        doc = xapian.Document()
+        doc.add_value(11, field.convert(-5, Entry))
+
+        self.assertEqual(field.extract(doc), -5)
+
+    def test_sortable_datetime(self):
+        field = Field("created_on", number=11)
+        field.compile(Entry, "sortable")
+
+        value = datetime(2009, 3, 1, 12, 30)
+
+        doc = xapian.Document()
+        doc.add_value(11, field.convert(value, Entry))
+
+        self.assertEqual(field.extract(doc), value)
+
 class ChangeTrackingTest(BaseTestCase):
     def setUp(self):
         p = Person.objects.create(name="Alex")
@@ -45,6 +88,9 @@ class ChangeTrackingTest(BaseTestCase):
     def test_change_count(self):
         self.assertEqual(Change.objects.count(), 2)
 
+    def test_version_column(self):
+        self.assert_(Change.objects.has_version())
+
 class ChangeTrackingUpdateTest(BaseTestCase):
     def setUp(self):
         p = Person.objects.create(name="Alex")
@@ -67,3 +113,36 @@ class ChangeTrackingDeleteTest(BaseTestCase):
 
     def test_change_count(self):
         self.assertEqual(Change.objects.count(), 0)
+
+class ChangeTrackingBulkTest(BaseTestCase):
+    def setUp(self):
+        p = Person.objects.create(name="Alex")
+        self.entries = [
+            Entry.objects.create(author=p, title="Entry %s" % i) for i in range(3)
+        ]
+
+    def test_added_then_edited(self):
+        Change.objects.enqueue_many(Entry, [e.pk for e in self.entries], "edit")
+
+        self.assertEqual(Change.objects.filter(action="add").count(), 3)
+
+    def test_added_then_deleted(self):
+        Change.objects.enqueue_many(Entry, [e.pk for e in self.entries[:2]], "delete")
+
+        self.assertEqual(Change.objects.filter(content_type__model="entry").count(), 1)
+
+    def test_edited_then_deleted(self):
+        Change.objects.all().delete()
+
+        Change.objects.enqueue_many(Entry, [e.pk for e in self.entries], "edit")
+        Change.objects.enqueue_many(Entry, [e.pk for e in self.entries], "delete")
+
+        self.assertEqual(Change.objects.filter(action="delete").count(), 3)
+
+    def test_delete_processed(self):
+        changes = list(Change.objects.values_list("pk", "version"))
+
+        Change.objects.enqueue(self.entries[0], "edit")
+        Change.objects.delete_processed(changes)
+
+        self.assertEqual(Change.objects.count(), 1)
@@ -2,6 +2,9 @@ from django.test import TestCase
 
 from djapian.tests.utils import BaseTestCase, BaseIndexerTest, Entry, Person
 from djapian import X
+from djapian.decider import apply_filters
+
+import xapian
 
 class FilteringTest(BaseIndexerTest, BaseTestCase):
     def setUp(self):
@@ -29,6 +32,74 @@ class FilteringTest(BaseIndexerTest, BaseTestCase):
         self.assertEqual(self.result.filter(X(count__lt=6) & ~X(count=5)).count(), 1)
         self.assertEqual(self.result.filter(X(count=7) | X(count=5)).count(), 2)
 
+    def test_strict_range(self):
+        self.assertEqual(self.result.filter(count__gt=5).count(), 1)
+        self.assertEqual(self.result.filter(count__lt=5).count(), 1)
+
+    def test_mixed(self):
+        self.assertEqual(
+            self.result.filter(count__gte=5, title__startswith='Third').count(),
+            1
+        )
+
+class FilterQueryTest(BaseTestCase):
+    def _apply(self, filter=None, exclude=None):
+        return apply_filters(
+            xapian.Query("text"),
+            Entry,
+            Entry.indexer.tags,
+            filter or X(),
+            exclude or X()
+        )
+
+    def test_native_lookups(self):
+        query, filter, exclude = self._apply(
+            X(count__in=[5, 7]) & X(rating__gt=4) & ~X(active=False),
+            X(count=5) | X(count=7)
+        )
+
+        self.assert_(not filter)
+        self.assert_(not exclude)
+
+    def test_decider_lookups(self):
+        query, filter, exclude = self._apply(
+            X(count=5) & X(title__contains='for'),
+            X(title__regex='^Test')
+        )
+
+        self.assertEqual(len(filter.children), 1)
+        self.assertEqual(filter.children[0][0], 'title__contains')
+        self.assert_(exclude)
+
+    def test_without_filter_terms(self):
+        query, filter, exclude = apply_filters(
+            xapian.Query("text"),
+            Entry,
+            Entry.indexer.tags,
+            X(count=5) & X(rating__gt=4),
+            X(),
+            filter_terms=False
+        )
+
+        self.assertEqual(len(filter.children), 1)
+        self.assertEqual(filter.children[0][0], 'count')
+
+class FilterTermsMarkerTest(BaseIndexerTest, BaseTestCase):
+    def test_marker(self):
+        self.assert_(Entry.indexer._db.has_filter_terms())
+
+    def test_old_index(self):
+        database = Entry.indexer._db.open(write=True)
+        database.set_metadata("djapian:filter_terms", "")
+        database.flush()
+        del database
+
+        self.assert_(not Entry.indexer._db.get_registry(refresh=True).filter_terms)
+        self.assertEqual(
+            Entry.indexer.search("text").filter(count=5).count(),
+            1
+        )
+
 class LookupTest(BaseIndexerTest, BaseTestCase):
     def setUp(self):
         super(LookupTest, self).setUp()
@@ -3,8 +3,10 @@ from datetime import datetime
 
 from django.db import models
 
-from djapian import Indexer, Field
+from djapian import Indexer, Field, Database
+from djapian.indexer import paginate
 from djapian.tests.utils import BaseTestCase, BaseIndexerTest, Entry, Person
+from djapian.models import Change
 
 class IndexerUpdateTest(BaseIndexerTest, BaseTestCase):
     def test_database_exists(self):
@@ -13,6 +15,315 @@ class IndexerUpdateTest(BaseIndexerTest, BaseTestCase):
     def test_document_count(self):
         self.assertEqual(Entry.indexer.document_count(), 3)
 
+class PaginateTest(BaseTestCase):
+    def setUp(self):
+        p = Person.objects.create(name="Alex")
+
+        self.entries = [
+            Entry.objects.create(author=p, title="Entry %s" % i) for i in range(5)
+        ]
+
+    def test_queryset(self):
+        self.assertEqual(
+            [e.pk for e in paginate(Entry.objects.all(), 2)],
+            sorted([e.pk for e in self.entries])
+        )
+
+    def test_update(self):
+        Entry.indexer.update(chunk_size=2)
+
+        self.assertEqual(Entry.indexer.document_count(), 5)
+
+class PkRangesTest(BaseTestCase):
+    def setUp(self):
+        p = Person.objects.create(name="Alex")
+
+        self.pks = [
+            Entry.objects.create(author=p, title="Entry %s" % i).pk for i in range(5)
+        ]
+
+    def test_ranges(self):
+        from djapian.management.commands.index import get_pk_ranges
+
+        ranges = get_pk_ranges(Entry, 2)
+
+        self.assertEqual(len(ranges), 2)
+        self.assertEqual(ranges[0][0], None)
+        self.assertEqual(ranges[-1][1], None)
+        self.assertEqual(ranges[0][1], ranges[1][0])
+
+    def test_more_workers_than_objects(self):
+        from djapian.management.commands.index import get_pk_ranges
+
+        self.assertEqual(len(get_pk_ranges(Entry, 10)), 5)
+
+class ParallelRebuildTest(BaseIndexerTest, BaseTestCase):
+    def rebuild(self, address):
+        from djapian.management.commands.index import get_indexer, rebuild_parallel
+
+        indexer = get_indexer(address)
+
+        shadow = indexer._db.create_shadow()
+        rebuild_parallel(address, shadow, False, False, False, None, 2,
+                         processes=False)
+        indexer._db.swap(shadow)
+
+        return indexer
+
+    def test_rebuild(self):
+        from djapian.management.commands.index import get_address
+
+        indexer = self.rebuild(get_address(Entry.indexer))
+
+        self.assertEqual(indexer.document_count(), 3)
+        self.assertEqual(indexer.search("text").count(), 3)
+
+    def test_rebuild_sharded(self):
+        from django.conf import settings
+        from djapian import IndexSpace
+        from djapian.tests.utils import EntryIndexer
+
+        # More shards than documents, so some of them stay empty
+        space = IndexSpace(
+            os.path.join(settings.DJAPIAN_DATABASE_PATH, "sharded"),
+            "sharded",
+            shards=5
+        )
+        try:
+            space.add_index(Entry, EntryIndexer)
+
+            indexer = self.rebuild((IndexSpace.instances.index(space), Entry, 0))
+
+            self.assertEqual(indexer.document_count(), 3)
+            self.assertEqual(indexer.search("text").count(), 3)
+            indexer.clear()
+        finally:
+            IndexSpace.instances.remove(space)
+
+class RegistryTest(BaseIndexerTest, BaseTestCase):
+    def test_registry(self):
+        registry = Entry.indexer._db.get_registry()
+
+        self.assertEqual(registry.models, ["djapian.Entry"])
+        self.assertEqual(registry.indexers, [Entry.indexer.get_descriptor()])
+
+    def test_packed_values(self):
+        doc = Entry.indexer._db.open().get_document(1)
+
+        self.assertEqual(doc.get_value(2), "0:0")
+        self.assertEqual(doc.get_value(3), "")
+
+    def test_delete_unregistered(self):
+        Entry.indexer.clear()
+        Entry.indexer.delete(self.entries[0])
+
+        database = Entry.indexer._db.open()
+        self.assertEqual(database.get_metadata("djapian:models"), "")
+        self.assertEqual(database.get_metadata("djapian:filter_terms"), "")
+
+class ShardedDatabaseTest(BaseTestCase):
+    def setUp(self):
+        from django.conf import settings
+        from djapian.database import ShardedDatabase
+        from djapian.tests.utils import EntryIndexer
+
+        p = Person.objects.create(name="Alex")
+
+        self.entries = [
+            Entry.objects.create(author=p, title="Entry %s" % i, text="sharded text")
+            for i in range(6)
+        ]
+
+        self.db = ShardedDatabase(
+            os.path.join(settings.DJAPIAN_DATABASE_PATH, "sharded"),
+            3
+        )
+        self.indexer = EntryIndexer(self.db, Entry)
+        self.indexer.update()
+
+    def tearDown(self):
+        self.db.clear()
+        super(ShardedDatabaseTest, self).tearDown()
+
+    def test_documents_routed(self):
+        counts = [shard.document_count() for shard in self.db.get_shards()]
+
+        self.assertEqual(sum(counts), 6)
+        for entry in self.entries:
+            shard = self.db.get_shard(entry.pk)
+            self.assert_(shard.open().term_exists(
+                self.indexer._create_uid(entry, "0:0")
+            ))
+
+    def test_search(self):
+        result = self.indexer.search("sharded")
+
+        self.assertEqual(result.count(), 6)
+        self.assertEqual(
+            sorted([hit.instance.pk for hit in result]),
+            sorted([entry.pk for entry in self.entries])
+        )
+
+    def test_delete(self):
+        self.indexer.delete(self.entries[0])
+
+        self.assertEqual(self.indexer.document_count(), 5)
+
+    def test_close(self):
+        writer = self.db.open(write=True)
+        writer.get_shard(self.entries[0].pk)
+        writer.close()
+
+        # Would raise DatabaseLockError if the shard was still locked
+        self.db.get_shard(self.entries[0].pk).open(write=True)
+
+class RebuildTest(BaseIndexerTest, BaseTestCase):
+    def test_swapped(self):
+        from django.core.management import call_command
+
+        path = Entry.indexer._db.get_paths()[0]
+        before = Entry.indexer.document_count()
+
+        call_command("index", rebuild_index=True)
+
+        self.assert_(os.path.islink(path + ".current"))
+        self.assertEqual(Entry.indexer.document_count(), before)
+
+    def test_recreated_path_ignored(self):
+        from djapian.database import swap_directory
+
+        db = Entry.indexer._db
+        path = db.get_paths()[0]
+
+        shadow = db.create_shadow()
+        database = shadow.open(write=True)
+        Entry.indexer.update(database=database)
+        database.flush()
+        del database
+        swap_directory(path, shadow._path)
+
+        # Reader racing with the swap may create empty database at path
+        Database(path).create_database()
+
+        self.assertEqual(db.get_location(), os.path.realpath(shadow._path))
+        self.assertEqual(db.document_count(), 3)
+
+    def test_readers_move_over(self):
+        from djapian.database import swap_directory
+
+        db = Entry.indexer._db
+        path = db.get_paths()[0]
+        handle = db.open()
+
+        shadow = db.create_shadow()
+        shadow.create_database()
+        swap_directory(path, shadow._path)
+
+        self.assert_(db.open() is not handle)
+        self.assertEqual(db.document_count(), 0)
+
+    def test_changed_during_rebuild(self):
+        from djapian.management.commands.index import rebuild_index, \
+                                                       update_changes, get_address
+
+        Change.objects.all().delete()
+        entry = self.entries[0]
+
+        def after_index(obj):
+            # First entry is indexed already, the daemon applies its change
+            # to the old index
+            if obj.pk == self.entries[2].pk:
+                entry.title = "Renamed entry"
+                entry.save()
+                update_changes(False, 0, True, False, False, 500)
+
+        rebuild_index(get_address(Entry.indexer), after_index, False, False,
+                      False, None)
+
+        self.assertEqual(Entry.indexer.search("renamed").count(), 1)
+
+        update_changes(False, 0, True, False, False, 500)
+
+        self.assertEqual(Change.objects.count(), 0)
+        self.assertEqual(Entry.indexer.search("renamed").count(), 1)
+
+class CompactTest(BaseIndexerTest, BaseTestCase):
+    def test_compact(self):
+        before = Entry.indexer.document_count()
+
+        Entry.indexer._db.compact()
+
+        self.assertEqual(Entry.indexer.document_count(), before)
+        self.assertEqual(Entry.indexer.search("text").count(), before)
+
+    def test_written_during_compaction(self):
+        db = Entry.indexer._db
+        create_shadow = db.create_shadow
+
+        def create_written_shadow():
+            shadow = create_shadow()
+            merge = shadow.merge
+
+            def merge_written(sources):
+                merge(sources)
+                if not Entry.objects.filter(title="Fresh entry"):
+                    Entry.objects.create(author=self.person, title="Fresh entry")
+                    Entry.indexer.update()
+
+            shadow.merge = merge_written
+            return shadow
+
+        db.create_shadow = create_written_shadow
+        try:
+            db.compact()
+        finally:
+            del db.create_shadow
+
+        self.assertEqual(Entry.indexer.search("fresh").count(), 1)
+
+    def test_daemon_waits(self):
+        from djapian.management.commands.index import update_changes, \
+                                                       create_marker
+
+        Change.objects.all().delete()
+        entry = self.entries[0]
+        entry.title = "Renamed entry"
+        entry.save()
+
+        marker = create_marker(Entry.indexer, "compact")
+        try:
+            update_changes(False, 0, True, False, False, 500)
+
+            self.assertEqual(Change.objects.count(), 1)
+            self.assertEqual(Entry.indexer.search("renamed").count(), 0)
+        finally:
+            os.remove(marker)
+
+        update_changes(False, 0, True, False, False, 500)
+
+        self.assertEqual(Change.objects.count(), 0)
+        self.assertEqual(Entry.indexer.search("renamed").count(), 1)
+
+class DatabasePoolTest(BaseIndexerTest, BaseTestCase):
+    def test_handle_reused(self):
+        self.assert_(Entry.indexer._db.open() is Entry.indexer._db.open())
+
+    def test_handle_reopened(self):
+        database = Entry.indexer._db.open()
+
+        Entry.objects.create(author=self.person, title="Fresh entry")
+        Entry.indexer.update()
+
+        self.assertEqual(Entry.indexer._db.open().get_doccount(), 4)
+        self.assert_(Entry.indexer._db.open() is database)
+
+    def test_clear_discards_handle(self):
+        database = Entry.indexer._db.open()
+        Entry.indexer.clear()
+
+        self.assert_(Entry.indexer._db.open() is not database)
+        self.assertEqual(Entry.indexer.document_count(), 0)
+
 class IndexCommandTest(BaseTestCase):
     def setUp(self):
         p = Person.objects.create(name="Alex")
@@ -33,3 +344,6 @@ class IndexCommandTest(BaseTestCase):
 
     def test_database(self):
         self.assertEqual(Entry.indexer.document_count(), 1)
+
+    def test_changes_drained(self):
+        self.assertEqual(Change.objects.count(), 0)
@@ -27,3 +27,39 @@ class ResultSetPaginationTest(BaseTestCase):
         self.assertEqual(paginator.num_pages, self.num_pages)
 
         page = paginator.page(5)
+
+class ResultSetWindowTest(BaseTestCase):
+    num_entries = 25
+
+    def setUp(self):
+        p = Person.objects.create(name="Alex")
+
+        for i in range(self.num_entries):
+            Entry.objects.create(
+                author=p,
+                title="Entry with number %s" % i,
+                text="foobar " * i
+            )
+
+        Entry.indexer.update()
+
+        self.result = Entry.indexer.search("title:number")
+        self.result.window_size = 10
+
+    def test_iteration(self):
+        self.assertEqual(len(list(self.result)), self.num_entries)
+        self.assertEqual(len(self.result._windows), 3)
+
+    def test_item(self):
+        self.assertEqual(self.result[12].rank, 12)
+        self.assertEqual(self.result[14].rank, 14)
+        self.assertEqual(self.result._windows.keys(), [1])
+
+    def test_item_out_of_range(self):
+        self.assertRaises(IndexError, lambda: self.result[self.num_entries])
+
+    def test_len_reuses_windows(self):
+        list(self.result[0:10])
+        self.result[5]
+
+        self.assertEqual(len(self.result), self.num_entries)
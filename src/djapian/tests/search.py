@@ -2,6 +2,9 @@ from django.test import TestCase
 
 from djapian.tests.utils import BaseTestCase, BaseIndexerTest, Entry, Person, Comment
 from djapian.indexer import CompositeIndexer
+from djapian.cache import LRUCache
+from djapian import timing, search_many
+from djapian.database import pool
 
 class IndexerSearchTextTest(BaseIndexerTest, BaseTestCase):
     def setUp(self):
@@ -23,6 +26,16 @@ class IndexerSearchTextTest(BaseIndexerTest, BaseTestCase):
 
         self.assertEqual(result, expected)
 
+    def test_count(self):
+        self.assertEqual(self.result.count(), 3)
+        self.assertEqual(self.result.count(exact=True), 3)
+        self.assertEqual(self.result[1:3].count(), 2)
+        self.assertEqual(self.result[2:10].count(), 1)
+
+    def test_exists(self):
+        self.assert_(self.result.exists())
+        self.assert_(not Entry.indexer.search("nonexistentword").exists())
+
     def test_score(self):
         self.assert_(self.result[0].percent in (99, 100))
 
@@ -40,6 +53,30 @@ class IndexerSearchTextTest(BaseIndexerTest, BaseTestCase):
         self.assert_(hasattr(result[0].instance, '_author_cache'))
         self.assertEqual(result[0].instance.author.name, 'Alex')
 
+    def test_prefetch_options(self):
+        result = self.result.prefetch(
+            querysets={Entry: lambda instances: instances.select_related('author')}
+        )
+        self.assert_(hasattr(result[0].instance, '_author_cache'))
+
+        result = self.result.prefetch(select_related=['author'])
+        self.assert_(hasattr(result[0].instance, '_author_cache'))
+
+        result = self.result.prefetch(
+            select_related=True,
+            querysets={Entry: Entry.objects.filter(is_active=True)}
+        )
+        self.assert_(hasattr(result[0].instance, '_author_cache'))
+
+    def test_prefetch_instance_cache(self):
+        result = self.result.prefetch()
+
+        first = result[0:1][0].instance
+        self.assertEqual(len(result._instance_cache[Entry]), 1)
+
+        self.assert_(result[0:3][0].instance is first)
+        self.assertEqual(len(result._instance_cache[Entry]), 3)
+
 class AliasesTest(BaseTestCase):
     num_entries = 5
 
@@ -71,3 +108,139 @@ class CompositeIndexerTest(BaseIndexerTest, BaseTestCase):
         results = self.indexer.search('entry')
 
         self.assertEqual(len(results), 4) # 3 entries + 1 comment
+
+class ResultCacheTest(BaseIndexerTest, BaseTestCase):
+    def setUp(self):
+        super(ResultCacheTest, self).setUp()
+        Entry.indexer.result_cache = LRUCache(size=2)
+
+    def tearDown(self):
+        Entry.indexer.result_cache = None
+        super(ResultCacheTest, self).tearDown()
+
+    def test_hit(self):
+        self.assertEqual(len(Entry.indexer.search("text")), 3)
+        self.assertEqual(len(Entry.indexer.result_cache), 1)
+
+        self.assertEqual(len(Entry.indexer.search("text")), 3)
+        self.assertEqual(len(Entry.indexer.result_cache), 1)
+
+    def test_invalidation(self):
+        self.assertEqual(len(Entry.indexer.search("text")), 3)
+
+        Entry.objects.create(author=self.person, title="New entry", text="text")
+        Entry.indexer.update()
+
+        self.assertEqual(len(Entry.indexer.search("text")), 4)
+
+    def test_swap(self):
+        self.assertEqual(len(Entry.indexer.search("text")), 3)
+
+        db = Entry.indexer._db
+        shadow = db.create_shadow()
+        database = shadow.open(write=True)
+        Entry.indexer.update(
+            Entry.objects.filter(pk=self.entries[0].pk),
+            database=database
+        )
+        database.flush()
+        del database
+        db.swap(shadow)
+
+        self.assertEqual(len(Entry.indexer.search("text")), 1)
+
+    def test_eviction(self):
+        for query in ("text", "entry", "message"):
+            list(Entry.indexer.search(query))
+
+        self.assertEqual(len(Entry.indexer.result_cache), 2)
+
+class TimingTest(BaseIndexerTest, BaseTestCase):
+    def setUp(self):
+        super(TimingTest, self).setUp()
+
+        self.timers = []
+        timing.add_hook(self.timers.append)
+
+    def tearDown(self):
+        timing.remove_hook(self.timers.append)
+        super(TimingTest, self).tearDown()
+
+    def test_search(self):
+        list(Entry.indexer.search("text").prefetch())
+
+        timer = self.timers[-1]
+        self.assertEqual(timer.operation, "search")
+        self.assertEqual(timer.info["query"], "text")
+        for phase in ("parse_query", "get_mset", "parse_results", "prefetch"):
+            self.assert_(phase in timer.phases)
+
+    def test_count(self):
+        Entry.indexer.search("text").count()
+
+        self.assertEqual(self.timers[-1].operation, "count")
+
+    def test_update(self):
+        Entry.indexer.update()
+
+        timer = self.timers[-1]
+        self.assertEqual(timer.operation, "update")
+        self.assertEqual(timer.info["documents"], 4)
+        self.assert_("write" in timer.phases)
+
+    def test_disabled(self):
+        timing.remove_hook(self.timers.append)
+        try:
+            self.assert_(timing.get_timer("update") is None)
+        finally:
+            timing.add_hook(self.timers.append)
+
+class AsyncSearchTest(BaseIndexerTest, BaseTestCase):
+    def test_fetch(self):
+        future = Entry.indexer.asearch("text").filter(count__gte=5).fetch(0, 10)
+        hits = future.result(10)
+
+        self.assertEqual(
+            sorted([hit.pk for hit in hits]),
+            [self.entries[1].pk, self.entries[2].pk]
+        )
+
+    def test_fetch_count(self):
+        self.assertEqual(Entry.indexer.asearch("text").fetch_count().result(10), 3)
+
+    def test_error(self):
+        future = Entry.indexer.asearch("text").order_by("missing").fetch()
+
+        self.assertRaises(ValueError, future.result, 10)
+
+class SearchManyTest(BaseIndexerTest, BaseTestCase):
+    def test_results(self):
+        hits, count = search_many([
+            Entry.indexer.search("text"),
+            Entry.indexer.search("entry").count
+        ])
+
+        self.assertEqual(len(hits), 3)
+        self.assertEqual(count, 3)
+
+    def test_threaded(self):
+        searches = [Entry.indexer.search(query) for query in ("text", "entry", "third")]
+
+        self.assertEqual(
+            [len(hits) for hits in search_many(searches, threaded=True)],
+            [3, 3, 1]
+        )
+
+    def test_snapshot(self):
+        pool.freeze()
+        try:
+            before = Entry.indexer.search("text").count()
+
+            Entry.objects.create(author=self.person, title="New entry", text="text")
+            Entry.indexer.update()
+
+            self.assertEqual(Entry.indexer.search("text").count(), before)
+        finally:
+            pool.thaw()
+
+        self.assertEqual(Entry.indexer.search("text").count(), before + 1)
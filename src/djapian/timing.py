@@ -0,0 +1,94 @@
+"""
+Timing of search and indexing phases.
+
+Functions registered with `add_hook` are called with each finished
+`Timer`, they get its `operation` ("search", "count", "exists" or
+"update"), `info` about the operation (query, filters, order etc.),
+`phases` (SortedDict of phase names and seconds spent in them) and total
+`duration`.
+
+Searches which take longer than `DJAPIAN_SLOW_QUERY_THRESHOLD` seconds
+(if the setting is defined) are logged with "djapian.slow_query" logger.
+
+Operations are timed only if there are hooks or slow searches are logged,
+`get_timer` returns None otherwise.
+"""
+import time
+import logging
+
+from django.conf import settings
+from django.utils.datastructures import SortedDict
+
+logger = logging.getLogger("djapian.slow_query")
+
+_hooks = []
+
+def add_hook(hook):
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+_unset = object()
+_threshold = _unset
+
+def get_threshold():
+    """
+    Returns `DJAPIAN_SLOW_QUERY_THRESHOLD` setting, it is read once
+    """
+    global _threshold
+
+    if _threshold is _unset:
+        _threshold = getattr(settings, "DJAPIAN_SLOW_QUERY_THRESHOLD", None)
+    return _threshold
+
+def get_timer(operation, **info):
+    """
+    Returns timer of `operation` or None if nothing would use it
+    """
+    if not _hooks and (operation == "update" or get_threshold() is None):
+        return None
+    return Timer(operation, **info)
+
+class Timer(object):
+    def __init__(self, operation, **info):
+        self.operation = operation
+        self.info = info
+        self.phases = SortedDict()
+        self.duration = None
+
+        self._started = self._last = time.time()
+
+    def lap(self, phase):
+        """
+        Adds time passed since previous lap to `phase`
+        """
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self._last
+        self._last = now
+
+    def finish(self):
+        self.duration = time.time() - self._started
+
+        for hook in _hooks:
+            hook(self)
+
+        if self.operation != "update":
+            threshold = get_threshold()
+            if threshold is not None and self.duration >= threshold:
+                self.log()
+
+    def log(self):
+        info = []
+        for name, value in self.info.items():
+            if isinstance(value, basestring):
+                value = repr(value)
+            info.append("%s=%s" % (name, value))
+
+        logger.warning(
+            "Slow %s (%.3fs): %s; phases: %s",
+            self.operation,
+            self.duration,
+            ", ".join(info),
+            ", ".join(["%s=%.3fs" % item for item in self.phases.items()])
+        )
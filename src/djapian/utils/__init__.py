@@ -1,11 +1,41 @@
+import threading
+
+import xapian
+
 from django.conf import settings
 
 DEFAULT_MAX_RESULTS = 100000
+DEFAULT_CHECK_AT_LEAST = 1000
+DEFAULT_WINDOW_SIZE = 100
 DEFAULT_WEIGHT = 1
+MAX_TERM_LENGTH = 240
 
 def model_name(model):
     return "%s.%s" % (model._meta.app_label, model._meta.object_name)
 
+_stemmers = threading.local()
+
+def get_stemmer(language):
+    """
+    Returns cached stemmer for given language. Stemmers keep internal
+    buffers so they are cached per thread.
+    """
+    try:
+        cache = _stemmers.cache
+    except AttributeError:
+        cache = _stemmers.cache = {}
+
+    try:
+        return cache[language]
+    except KeyError:
+        if language:
+            stemmer = xapian.Stem(language)
+        else:
+            stemmer = xapian.Stem()
+
+        cache[language] = stemmer
+        return stemmer
+
 def load_indexes():
     from djapian.utils import loading
     for app in settings.INSTALLED_APPS: